@@ -66,4 +66,5 @@ urlpatterns = (
 
     url(r'^test_order_email/(?P<id>[-\w]+)/$', test_order_email, name="admin_test_order_email"),
     url(r'^resaver/orders/$', resave_orders, name="admin_resave_orders"),
+    url(r'^resaver/foodbanks/$', resave_foodbanks, name="admin_resave_foodbanks"),
 )
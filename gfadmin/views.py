@@ -4,7 +4,8 @@ from datetime import datetime, timedelta
 
 from djangae.environment import is_production_environment
 
-from google.appengine.api import urlfetch, memcache
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
 from google.appengine.ext import deferred
 
 from django.shortcuts import render, get_object_or_404
@@ -16,8 +17,8 @@ from django.shortcuts import redirect
 from django.views.decorators.http import require_POST
 from django.utils.encoding import smart_str
 
-from givefood.const.general import PACKAGING_WEIGHT_PC
-from givefood.func import get_all_foodbanks, get_all_locations, get_cred, post_to_facebook, post_to_twitter, post_to_subscriber, send_email
+from givefood.const.general import PACKAGING_WEIGHT_PC, FB_GEN_MC_KEY, LOC_GEN_MC_KEY, ITEMS_GEN_MC_KEY, ADMIN_PAGE_SIZE, COUNTER_NAMES, COUNTRIES
+from givefood.func import get_all_foodbanks, get_all_locations, get_cred, post_to_facebook, post_to_twitter, post_to_subscriber, send_email, get_geocode_stats, bump_generation, clear_cred_cache, get_page, next_page_url, get_order_totals, get_counts, country_counter
 from givefood.models import Foodbank, Order, OrderLine, OrderItem, FoodbankChange, FoodbankLocation, ApiFoodbankSearch, ParliamentaryConstituency, GfCredential, FoodbankSubscriber
 from givefood.forms import FoodbankForm, OrderForm, NeedForm, FoodbankPoliticsForm, FoodbankLocationForm, FoodbankLocationPoliticsForm, ParliamentaryConstituencyForm, OrderItemForm, GfCredentialForm
 
@@ -99,11 +100,12 @@ def foodbanks(request):
     if sort != "name":
         sort = "-%s" % (sort)
 
-    foodbanks = Foodbank.objects.all().order_by(sort)
+    foodbanks, next_cursor = get_page(Foodbank.objects.all().order_by(sort), request.GET.get("cursor"), ADMIN_PAGE_SIZE)
 
     template_vars = {
         "sort":sort_string,
         "foodbanks":foodbanks,
+        "next_url":next_cursor and next_page_url(request, next_cursor),
         "section":"foodbanks",
     }
     return render(request, "foodbanks.html", template_vars)
@@ -150,11 +152,12 @@ def orders(request):
     sort_string = sort
     sort = "-%s" % (sort)
 
-    orders = Order.objects.all().order_by(sort)
+    orders, next_cursor = get_page(Order.objects.all().order_by(sort), request.GET.get("cursor"), ADMIN_PAGE_SIZE)
 
     template_vars = {
         "sort":sort_string,
         "orders":orders,
+        "next_url":next_cursor and next_page_url(request, next_cursor),
         "section":"orders",
     }
     return render(request, "orders.html", template_vars)
@@ -486,11 +489,12 @@ def locations(request):
     if sort not in sort_options:
         return HttpResponseForbidden()
 
-    locations = FoodbankLocation.objects.all().order_by(sort)
+    locations, next_cursor = get_page(FoodbankLocation.objects.all().order_by(sort), request.GET.get("cursor"), ADMIN_PAGE_SIZE)
 
     template_vars = {
         "sort":sort,
         "locations":locations,
+        "next_url":next_cursor and next_page_url(request, next_cursor),
         "section":"locations",
     }
     return render(request, "locations.html", template_vars)
@@ -630,39 +634,42 @@ def stats(request):
 
     all_foodbanks = get_all_foodbanks()
     total_foodbanks = len(all_foodbanks)
-    active_foodbanks = set()
 
-    needs = FoodbankChange.objects.all()
-    total_needs = len(needs)
-    total_need_items = 0
-    for need in needs:
-        total_need_items = total_need_items + need.no_items()
+    counts = get_counts(COUNTER_NAMES + [country_counter(name, country) for name in COUNTER_NAMES for country in COUNTRIES])
+    total_needs = counts["needs"]
+    total_need_items = counts["need_items"]
 
     locations = get_all_locations()
     total_locations = len(locations) + total_foodbanks
 
-    total_weight = 0
-    total_calories = 0
-    total_items = 0
-    total_cost = 0
-
-    all_orders = Order.objects.all()
-    total_orders = len(all_orders)
-    for order in all_orders:
-        total_weight = total_weight + order.weight
-        total_calories = total_calories + order.calories
-        total_items = total_items + order.no_items
-        total_cost = total_cost + order.cost
-        active_foodbanks.add(order.foodbank_name)
+    order_totals = get_order_totals()
+    total_orders = order_totals["total"]["orders"]
+    total_weight = order_totals["total"]["weight"]
+    total_calories = order_totals["total"]["calories"]
+    total_items = order_totals["total"]["items"]
+    total_cost = order_totals["total"]["cost"]
 
     total_weight = total_weight / 1000
     total_weight_pkg = total_weight * PACKAGING_WEIGHT_PC
     total_cost = float(total_cost) / 100
 
-    total_active_foodbanks = len(active_foodbanks)
+    total_active_foodbanks = order_totals["total"]["active_foodbanks"]
+
+    total_subscriptions = counts["subscriptions"]
 
-    subscriptions = FoodbankSubscriber.objects.filter(confirmed = True)
-    total_subscriptions = len(subscriptions)
+    countries = []
+    for country in COUNTRIES:
+        country_order_totals = order_totals["countries"].get(country, {})
+        countries.append({
+            "name":country,
+            "active_foodbanks":country_order_totals.get("active_foodbanks", 0),
+            "orders":country_order_totals.get("orders", 0),
+            "weight":country_order_totals.get("weight", 0) / 1000,
+            "needs":counts[country_counter("needs", country)],
+            "subscriptions":counts[country_counter("subscriptions", country)],
+        })
+
+    geocode_stats = get_geocode_stats()
 
     template_vars = {
         "total_foodbanks":total_foodbanks,
@@ -677,6 +684,8 @@ def stats(request):
         "total_weight_pkg":total_weight_pkg,
         "total_locations":total_locations,
         "total_subscriptions":total_subscriptions,
+        "countries":countries,
+        "geocode_stats":geocode_stats,
         "section":"stats",
     }
     return render(request, "stats.html", template_vars)
@@ -701,6 +710,15 @@ def resave_orders(request):
     return HttpResponse("OK")
 
 
+def resave_foodbanks(request):
+
+    foodbanks = Foodbank.objects.all()
+    for foodbank in foodbanks:
+        deferred.defer(foodbank.save)
+
+    return HttpResponse("OK")
+
+
 def parlcon_form(request, slug = None):
 
     if slug:
@@ -805,6 +823,7 @@ def credentials_form(request):
         form = GfCredentialForm(request.POST)
         if form.is_valid():
             need = form.save()
+            clear_cred_cache()
             return redirect("admin_credentials")
     else:
         form = GfCredentialForm()
@@ -819,11 +838,12 @@ def credentials_form(request):
 
 def subscriptions(request):
 
-    subscriptions = FoodbankSubscriber.objects.all().order_by("-created")
+    subscriptions, next_cursor = get_page(FoodbankSubscriber.objects.all().order_by("-created"), request.GET.get("cursor"), ADMIN_PAGE_SIZE)
 
     template_vars = {
         "section":"settings",
         "subscriptions":subscriptions,
+        "next_url":next_cursor and next_page_url(request, next_cursor),
     }
     return render(request, "subscriptions.html", template_vars)
 
@@ -840,5 +860,9 @@ def delete_subscription(request):
 
 def clearcache(request):
 
+    # Flushing takes the cached pages with it, and the new generations
+    # make every instance drop the snapshots it holds
     memcache.flush_all()
+    for gen_mc_key in [FB_GEN_MC_KEY, LOC_GEN_MC_KEY, ITEMS_GEN_MC_KEY]:
+        bump_generation(gen_mc_key)
     return redirect("admin_index")
\ No newline at end of file
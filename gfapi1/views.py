@@ -9,7 +9,7 @@ from django.views.decorators.cache import cache_page
 from django.shortcuts import get_object_or_404
 from django.core.urlresolvers import reverse
 
-from givefood.func import find_foodbanks, get_all_foodbanks, geocode
+from givefood.func import find_foodbanks, get_all_foodbanks, geocode, get_snapshot_page, get_page_size, set_next_page_link
 from givefood.models import ApiFoodbankSearch, Foodbank, FoodbankChange
 from givefood.const.general import API_DOMAIN
 
@@ -24,6 +24,7 @@ def api_foodbanks(request):
     default_format = "json"
 
     foodbanks = get_all_foodbanks()
+    next_cursor = None
     response_list = []
 
     format = request.GET.get("format", default_format)
@@ -31,6 +32,9 @@ def api_foodbanks(request):
     if format not in allowed_formats:
         return HttpResponseBadRequest()
 
+    if "cursor" in request.GET or "limit" in request.GET:
+        foodbanks, next_cursor = get_snapshot_page(foodbanks, request.GET.get("cursor"), get_page_size(request))
+
     for foodbank in foodbanks:
         response_list.append({
             "name":foodbank.name,
@@ -56,7 +60,8 @@ def api_foodbanks(request):
         })
 
     if format == "json":
-        return JsonResponse(response_list, safe=False)
+        response = JsonResponse(response_list, safe=False)
+        return set_next_page_link(request, response, next_cursor)
 
     if format == "csv":
         response = HttpResponse(content_type='text/csv')
@@ -107,7 +112,7 @@ def api_foodbanks(request):
                 foodbank["network"],
             ])
         writer.writerows(writer_output)
-        return response
+        return set_next_page_link(request, response, next_cursor)
 
 
 
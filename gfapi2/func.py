@@ -1,8 +1,12 @@
 import yaml
 import dicttoxml
-import logging
+import logging, json, hashlib, numbers, threading
+from collections import OrderedDict
 from xml.dom.minidom import parseString
-from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.core.serializers.json import DjangoJSONEncoder
+
+from givefood.const.general import API_SNAPSHOT_CACHE_SIZE
 
 
 def accceptable_formats(obj_name):
@@ -32,27 +36,295 @@ def constituency_geojson(data):
     return {}
 
 
-def ApiResponse(data, obj_name, format):
+def ApiResponse(data, obj_name, format, projection=None):
 
     valid_formats = accceptable_formats(obj_name)
 
     if format not in valid_formats:
         return HttpResponseBadRequest()
 
+    if projection:
+        data = projection.apply(data, format)
+
+    content, content_type = serialise(data, obj_name, format)
+    response = HttpResponse(content, content_type=content_type)
+    
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+
+def serialise(data, obj_name, format):
+
     if format == "json" or format == "geojson":
-        response = JsonResponse(data, safe=False, json_dumps_params={'indent': 2})
+        json_str = json.dumps(data, cls=DjangoJSONEncoder, indent=2)
+        return json_str, "application/json"
     elif format == "xml":
-        dicttoxml.LOG.setLevel(logging.ERROR)
-        xml_str = dicttoxml.dicttoxml(data, attr_type=False, custom_root=obj_name, item_func=xml_item_name)
-        xml_dom = parseString(xml_str)
-        xml_str = xml_dom.toprettyxml()
-        response = HttpResponse(xml_str, content_type="text/xml")
+        xml_str = u"".join(iter_pretty_xml(data, obj_name, xml_item_name))
+        return xml_str, "text/xml"
     elif format == "yaml":
-        yaml_str = yaml.safe_dump(data, encoding='utf-8', allow_unicode=True, default_flow_style=False)
-        response = HttpResponse(yaml_str, content_type="text/yaml")
-    
+        yaml_str = yaml.dump(data, Dumper=YamlDumper, encoding='utf-8', allow_unicode=True, default_flow_style=False)
+        return yaml_str, "text/yaml"
+
+
+# libyaml's dumper where it's been built in. App Engine's PyYAML doesn't
+# have it, so there this is the same pure Python dumper as safe_dump.
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+def iter_pretty_xml(data, root_name, item_func):
+    """
+    Pretty printed XML for data, in pieces. This is what dicttoxml
+    followed by minidom's toprettyxml gives, in one pass without
+    building dicttoxml's XML string or a DOM of it. The pieces are joined
+    into the response, so the finished document is still all in memory.
+    """
+
+    yield u'<?xml version="1.0" ?>\n'
+    for piece in iter_xml_element(root_name, {}, data, u"", item_func, root_name):
+        yield piece
+
+
+def iter_xml_element(name, attrs, value, indent, item_func, parent):
+
+    start = indent + u"<" + name + xml_attr_string(attrs)
+
+    if not is_xml_collection(value):
+        text = xml_text(value)
+        if text:
+            yield start + u">" + text + u"</" + name + u">\n"
+        else:
+            yield start + u"/>\n"
+        return
+
+    if isinstance(value, dict):
+        children = value.items()
+    else:
+        item_name = item_func(parent)
+        children = ((item_name, item) for item in value)
+
+    first = True
+    for child_name, child_value in children:
+        if first:
+            yield start + u">\n"
+            first = False
+        if isinstance(value, dict):
+            child_name, child_attrs = xml_name(child_name)
+            child_parent = child_name
+        elif is_xml_collection(child_value):
+            child_attrs = {}
+            # dicts in a list name their own list items
+            child_parent = parent if isinstance(child_value, dict) else child_name
+        else:
+            child_name, child_attrs = xml_name(child_name)
+            child_parent = child_name
+        for piece in iter_xml_element(child_name, child_attrs, child_value, indent + u"\t", item_func, child_parent):
+            yield piece
+
+    if first:
+        yield start + u"/>\n"
+    else:
+        yield indent + u"</" + name + u">\n"
+
+
+def is_xml_collection(value):
+
+    # dicttoxml checks for numbers first, so bools come out as True/False
+    return not (value is None or isinstance(value, (numbers.Number, basestring)) or hasattr(value, "isoformat"))
+
+
+def xml_text(value):
+
+    if value is None:
+        return u""
+    if hasattr(value, "isoformat") and not isinstance(value, (numbers.Number, basestring)):
+        value = value.isoformat()
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    else:
+        value = unicode(value)
+
+    # What an XML parser does to line endings, then minidom's escaping
+    value = value.replace(u"\r\n", u"\n").replace(u"\r", u"\n")
+    return value.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u"\"", u"&quot;").replace(u">", u"&gt;")
+
+
+def xml_attr_string(attrs):
+
+    attr_string = u""
+    for attr_name in sorted(attrs):
+        attr_value = attrs[attr_name]
+        for whitespace in [u"\r\n", u"\r", u"\n", u"\t"]:
+            attr_value = attr_value.replace(whitespace, u" ")
+        attr_string += u' %s="%s"' % (attr_name, attr_value.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u"\"", u"&quot;").replace(u">", u"&gt;"))
+    return attr_string
+
+
+# dicttoxml's fixed up names for keys, which are slow to work out
+_xml_names = {}
+
+
+def xml_name(key):
+
+    if key not in _xml_names:
+        dicttoxml.LOG.setLevel(logging.ERROR)
+        name, attrs = dicttoxml.make_valid_xml_name(key, {})
+        # Undo dicttoxml's escaping, as minidom would when reading it
+        for attr_name in attrs:
+            attrs[attr_name] = parseString((u'<a b="%s"/>' % (attrs[attr_name])).encode("utf-8")).documentElement.getAttribute("b")
+        _xml_names[key] = (name, attrs)
+    name, attrs = _xml_names[key]
+    return name, dict(attrs)
+
+
+class Projection(object):
+    """
+    The fields asked for with fields=, as a tree of names. Dotted paths
+    such as politics.mp pick fields inside nested blocks, and lists are
+    projected item by item. With no fields everything is returned.
+    """
+
+    def __init__(self, fields):
+
+        paths = sorted(set(path.strip() for path in (fields or "").split(",") if path.strip()))
+        # Identifies the shape, for caching
+        self.key = ",".join(paths)
+
+        self.tree = {}
+        for path in paths:
+            names = path.split(".")
+            node = self.tree
+            for name in names[:-1]:
+                if node.get(name) is True:
+                    break
+                node = node.setdefault(name, {})
+            else:
+                node[names[-1]] = True
+
+    def __nonzero__(self):
+        return bool(self.tree)
+
+    def wants(self, path):
+        """
+        Whether anything at or under path was asked for, so whatever
+        it takes to work it out can be skipped if not.
+        """
+
+        node = self.tree
+        if not node:
+            return True
+        for name in path.split("."):
+            node = node.get(name)
+            if node is None:
+                return False
+            if node is True:
+                return True
+        return True
+
+    def apply(self, data, format):
+
+        if not self.tree:
+            return data
+
+        # Only the properties of GeoJSON points are projected, so the
+        # result is still GeoJSON
+        if format == "geojson":
+            features = []
+            for feature in data["features"]:
+                if feature["geometry"]["type"] == "Point":
+                    feature = dict(feature, properties=project(feature["properties"], self.tree))
+                features.append(feature)
+            return dict(data, features=features)
+
+        return project(data, self.tree)
+
+
+# Every field, for when nothing was asked for
+ALL_FIELDS = Projection(None)
+
+
+def project(data, tree):
+
+    if tree is True:
+        return data
+    if isinstance(data, list):
+        return [project(item, tree) for item in data]
+    if isinstance(data, dict):
+        return dict((name, project(data[name], subtree)) for name, subtree in tree.items() if name in data)
+    return data
+
+
+# Rendered responses, keyed by (obj_name, format, projection), least
+# recently used first. Each is stored with the snapshot of objects it was
+# rendered from. Projections come from the request, so only the most
+# recently used few are kept.
+_api_snapshots = OrderedDict()
+_api_snapshots_lock = threading.Lock()
+
+
+def ApiSnapshotResponse(request, obj_name, format, objects, build_data, projection):
+    """
+    A response for a whole list, rendered once from a snapshot of
+    objects and kept on this instance until the snapshot changes. Each
+    format is stored serialised, and served with an ETag so clients can
+    revalidate for nothing. Compression is left to App Engine's front
+    end, which won't pass on a Content-Encoding set here.
+    """
+
+    valid_formats = accceptable_formats(obj_name)
+
+    if format not in valid_formats:
+        return HttpResponseBadRequest()
+
+    cache_key = (obj_name, format, projection.key)
+    with _api_snapshots_lock:
+        cached_snapshot = _api_snapshots.pop(cache_key, None)
+        if cached_snapshot:
+            _api_snapshots[cache_key] = cached_snapshot
+
+    if cached_snapshot and cached_snapshot[0] is objects:
+        api_snapshot = cached_snapshot[1]
+    else:
+        data = projection.apply(build_data(objects, format, projection), format)
+        content, content_type = serialise(data, obj_name, format)
+        api_snapshot = ApiSnapshot(content, content_type)
+        with _api_snapshots_lock:
+            _api_snapshots[cache_key] = (objects, api_snapshot)
+            while len(_api_snapshots) > API_SNAPSHOT_CACHE_SIZE:
+                _api_snapshots.popitem(last=False)
+
+    if etag_matches(request.META.get("HTTP_IF_NONE_MATCH", ""), api_snapshot.etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(api_snapshot.content, content_type=api_snapshot.content_type)
+
+    response["ETag"] = api_snapshot.etag
     response["Access-Control-Allow-Origin"] = "*"
     return response
 
 
+class ApiSnapshot(object):
+
+    def __init__(self, content, content_type):
+
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+
+        self.content = content
+        self.content_type = content_type
+        self.etag = '"%s"' % (hashlib.sha1(content).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
 xml_item_name = lambda x: x[:-1]
\ No newline at end of file
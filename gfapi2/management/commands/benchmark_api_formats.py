@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, json, time, logging, resource
+
+import yaml
+import dicttoxml
+from xml.dom.minidom import parseString
+
+from django.core.management.base import BaseCommand
+
+from givefood.func import get_all_foodbanks
+from gfapi2.func import serialise, xml_item_name
+from gfapi2.views import foodbanks_data
+
+
+def old_xml(data):
+
+    dicttoxml.LOG.setLevel(logging.ERROR)
+    xml_str = dicttoxml.dicttoxml(data, attr_type=False, custom_root="foodbanks", item_func=xml_item_name)
+    return parseString(xml_str).toprettyxml()
+
+
+def old_yaml(data):
+
+    return yaml.safe_dump(data, encoding='utf-8', allow_unicode=True, default_flow_style=False)
+
+
+def new_xml(data):
+
+    return serialise(data, "foodbanks", "xml")[0]
+
+
+def new_yaml(data):
+
+    return serialise(data, "foodbanks", "yaml")[0]
+
+
+def measure(serialiser, data):
+    """
+    Seconds taken and the growth in peak memory, in what the platform's
+    ru_maxrss counts in (kilobytes on Linux, bytes on macOS). Each run is
+    in a forked process so one can't hide another's peak.
+    """
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        serialiser(data)
+        seconds = time.time() - start
+        peak_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before
+        os.write(write_fd, json.dumps([seconds, peak_growth]))
+        os._exit(0)
+
+    os.close(write_fd)
+    result = os.read(read_fd, 1024)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+
+class Command(BaseCommand):
+    help = "Compares the old and new XML and YAML serialisers on the full /api/2/foodbanks/ payload"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", help="A saved /api/2/foodbanks/ response to use, rather than the datastore")
+        parser.add_argument("--runs", type=int, default=3)
+
+    def handle(self, *args, **options):
+
+        if options["json"]:
+            with open(options["json"]) as json_file:
+                data = json.load(json_file)
+        else:
+            data = foodbanks_data(get_all_foodbanks(), "json")
+
+        self.stdout.write("%s food banks" % (len(data)))
+
+        for name, old, new in [("xml", old_xml, new_xml), ("yaml", old_yaml, new_yaml)]:
+            if old(data) != new(data):
+                self.stdout.write("%s output differs!" % (name))
+
+            for label, serialiser in [("old", old), ("new", new)]:
+                results = [measure(serialiser, data) for run in range(options["runs"])]
+                seconds = min(seconds for seconds, peak_growth in results)
+                peak_growth = max(peak_growth for seconds, peak_growth in results)
+                self.stdout.write("%s %s: %.3fs, peak memory +%s" % (name, label, seconds, peak_growth))
@@ -7,9 +7,11 @@ urlpatterns = (
     url(r'^foodbanks/$', foodbanks, name="foodbanks"),
     url(r'^foodbank/(?P<slug>[-\w]+)/$', foodbank, name="foodbank"),
     url(r'^foodbanks/search/$', foodbank_search, name="foodbank_search"),
+    url(r'^foodbanks/search/batch/$', foodbank_search_batch, name="foodbank_search_batch"),
     url(r'^locations/$', locations, name="locations"),
     url(r'^locations/search/$', location_search, name="location_search"),
     url(r'^needs/$', needs, name="needs"),
     url(r'^need/(?P<id>\b[0-9a-f]{8}\b)/$', need, name="need"),
+    url(r'^changes/$', changes, name="changes"),
     url(r'^constituency/(?P<slug>[-\w]+)/$', constituency, name="constituency"),
 )
\ No newline at end of file
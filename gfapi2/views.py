@@ -1,14 +1,20 @@
-import logging
+import logging, json
+from datetime import timedelta
+from collections import OrderedDict
 
 from django.shortcuts import get_object_or_404, render
 from django.template import RequestContext
 from django.http import HttpResponseBadRequest
 from django.template.defaultfilters import slugify
 from django.views.decorators.cache import cache_page, cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.utils import timezone
 
-from givefood.models import Foodbank, ApiFoodbankSearch, FoodbankChange, ParliamentaryConstituency, FoodbankChange
-from .func import ApiResponse
-from givefood.func import get_all_foodbanks, get_all_locations, find_foodbanks, geocode, find_locations, is_uk
+from givefood.models import Foodbank, ApiFoodbankSearch, FoodbankChange, ParliamentaryConstituency, FoodbankChange, FoodbankLocation, Tombstone
+from .func import ApiResponse, ApiSnapshotResponse, Projection, ALL_FIELDS, accceptable_formats
+from givefood.func import get_all_foodbanks, get_all_locations, find_foodbanks, find_foodbanks_many, geocode, geocode_many, lattlong_from_postcode, find_locations, is_uk, get_latest_needs, get_snapshot_page, get_page_size, set_next_page_link, changes_cursor, changes_cursor_datetime
+from givefood.const.general import BOUNDARY_SIMPLIFY_TOLERANCES, CHANGES_LIMIT, CHANGES_LAG, SEARCH_BATCH_SIZE
 
 DEFAULT_FORMAT = "json"
 
@@ -56,12 +62,20 @@ def docs(request):
         "North Somerset",
     }
 
+    eg_changes_since = [
+        {"name":"An hour ago","since":changes_cursor(timezone.now() - timedelta(hours = 1))},
+        {"name":"A day ago","since":changes_cursor(timezone.now() - timedelta(days = 1))},
+        {"name":"A week ago","since":changes_cursor(timezone.now() - timedelta(days = 7))},
+    ]
+
     template_vars = {
         "api_formats":api_formats,
         "eg_foodbanks":eg_foodbanks,
         "eg_searches":eg_searches,
         "eg_needs":eg_needs,
         "eg_parl_cons":eg_parl_cons,
+        "eg_changes_since":eg_changes_since,
+        "search_batch_size":SEARCH_BATCH_SIZE,
     }
 
     return render(request, "docs.html", template_vars)
@@ -71,13 +85,24 @@ def docs(request):
 def foodbanks(request):
 
     format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
+
+    # Paged when asked for, otherwise the whole prerendered list
+    if "cursor" in request.GET or "limit" in request.GET:
+        foodbanks, next_cursor = get_snapshot_page(get_all_foodbanks(), request.GET.get("cursor"), get_page_size(request))
+        response = ApiResponse(foodbanks_data(foodbanks, format, projection), "foodbanks", format, projection)
+        return set_next_page_link(request, response, next_cursor)
+
+    return ApiSnapshotResponse(request, "foodbanks", format, get_all_foodbanks(), foodbanks_data, projection)
+
+
+def foodbanks_data(foodbanks, format, projection=ALL_FIELDS):
 
-    foodbanks = get_all_foodbanks()
     response_list = []
 
     if format != "geojson":
         for foodbank in foodbanks:
-            response_list.append({
+            foodbank_dict = {
                 "name":foodbank.name,
                 "alt_name":foodbank.alt_name,
                 "slug":foodbank.slug,
@@ -91,12 +116,6 @@ def foodbanks(request):
                 "lat_lng":foodbank.latt_long,
                 "network":foodbank.network,
                 "created":foodbank.created,
-                "urls": {
-                    "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.slug),
-                    "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.slug),
-                    "homepage":foodbank.url,
-                    "shopping_list":foodbank.shopping_list_url,
-                },
                 "charity": {
                     "registration_id":foodbank.charity_number,
                     "register_url":foodbank.charity_register_url(),
@@ -108,12 +127,23 @@ def foodbanks(request):
                     "mp_parl_id":foodbank.mp_parl_id,
                     "ward":foodbank.ward,
                     "district":foodbank.district,
-                    "urls": {
-                        "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
-                        "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
-                    },
                 }
-            })
+            }
+
+            if projection.wants("urls"):
+                foodbank_dict["urls"] = {
+                    "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.slug),
+                    "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.slug),
+                    "homepage":foodbank.url,
+                    "shopping_list":foodbank.shopping_list_url,
+                }
+            if projection.wants("politics.urls"):
+                foodbank_dict["politics"]["urls"] = {
+                    "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
+                    "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
+                }
+
+            response_list.append(foodbank_dict)
     else:
         features = []
         for foodbank in foodbanks:
@@ -144,58 +174,66 @@ def foodbanks(request):
             "features": features
         }
 
-    return ApiResponse(response_list, "foodbanks", format)
+    return response_list
 
 
 @cache_page(60*20)
 def foodbank(request, slug):
 
     format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
     foodbank = get_object_or_404(Foodbank, slug = slug)
 
     # Locations
-    locations = foodbank.locations()
+    if projection.wants("locations"):
+        locations = foodbank.locations()
+    else:
+        locations = []
     location_list = []
     for location in locations:
-        location_list.append(
-            {
-                "name":location.name,
-                "slug":location.slug,
-                "address":location.full_address(),
-                "postcode":location.postcode,
-                "lat_lng":location.latt_long,
-                "phone":location.phone_number,
-                "politics": {
-                    "parliamentary_constituency":location.parliamentary_constituency,
-                    "mp":location.mp,
-                    "mp_party":location.mp_party,
-                    "mp_parl_id":foodbank.mp_parl_id,
-                    "ward":location.ward,
-                    "district":location.district,
-                    "urls": {
-                        "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (location.parliamentary_constituency_slug),
-                        "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (location.parliamentary_constituency_slug),
-                    },
-                }
+        location_dict = {
+            "name":location.name,
+            "slug":location.slug,
+            "address":location.full_address(),
+            "postcode":location.postcode,
+            "lat_lng":location.latt_long,
+            "phone":location.phone_number,
+            "politics": {
+                "parliamentary_constituency":location.parliamentary_constituency,
+                "mp":location.mp,
+                "mp_party":location.mp_party,
+                "mp_parl_id":foodbank.mp_parl_id,
+                "ward":location.ward,
+                "district":location.district,
             }
-        )
+        }
+        if projection.wants("locations.politics.urls"):
+            location_dict["politics"]["urls"] = {
+                "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (location.parliamentary_constituency_slug),
+                "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (location.parliamentary_constituency_slug),
+            }
+        location_list.append(location_dict)
 
+    if projection.wants("nearby_foodbanks"):
+        nearby_foodbanks = foodbank.nearby()
+    else:
+        nearby_foodbanks = []
     nearby_foodbank_list = []
-    for nearby_foodbank in foodbank.nearby():
-        nearby_foodbank_list.append(
-            {
-                "name":nearby_foodbank.name,
-                "slug":nearby_foodbank.slug,
-                "urls": {
-                    "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (nearby_foodbank.slug),
-                    "html":"https://www.givefood.org.uk/needs/at/%s/" % (nearby_foodbank.slug),
-                    "homepage":nearby_foodbank.url,
-                    "shopping_list":nearby_foodbank.shopping_list_url,
-                },
-                "address":nearby_foodbank.full_address(),
-                "lat_lng":nearby_foodbank.latt_long,
+    for nearby_foodbank in nearby_foodbanks:
+        nearby_foodbank_dict = {
+            "name":nearby_foodbank.name,
+            "slug":nearby_foodbank.slug,
+            "address":nearby_foodbank.full_address(),
+            "lat_lng":nearby_foodbank.latt_long,
+        }
+        if projection.wants("nearby_foodbanks.urls"):
+            nearby_foodbank_dict["urls"] = {
+                "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (nearby_foodbank.slug),
+                "html":"https://www.givefood.org.uk/needs/at/%s/" % (nearby_foodbank.slug),
+                "homepage":nearby_foodbank.url,
+                "shopping_list":nearby_foodbank.shopping_list_url,
             }
-        )
+        nearby_foodbank_list.append(nearby_foodbank_dict)
 
     response_dict = {
         "name":foodbank.name,
@@ -210,13 +248,6 @@ def foodbank(request, slug):
         "lat_lng":foodbank.latt_long,
         "network":foodbank.network,
         "created":foodbank.created,
-        "urls": {
-            "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.slug),
-            "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.slug),
-            "homepage":foodbank.url,
-            "shopping_list":foodbank.shopping_list_url,
-            "map":"https://www.givefood.org.uk/needs/at/%s/map.png" % (foodbank.slug),
-        },
         "charity": {
             "registration_id":foodbank.charity_number,
             "register_url":foodbank.charity_register_url(),
@@ -228,27 +259,40 @@ def foodbank(request, slug):
             "mp_party":foodbank.mp_party,
             "ward":foodbank.ward,
             "district":foodbank.district,
-            "urls": {
-                "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
-                "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
-            },
         },
-        "need": {
+        "nearby_foodbanks": nearby_foodbank_list,
+    }
+
+    if projection.wants("urls"):
+        response_dict["urls"] = {
+            "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.slug),
+            "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.slug),
+            "homepage":foodbank.url,
+            "shopping_list":foodbank.shopping_list_url,
+            "map":"https://www.givefood.org.uk/needs/at/%s/map.png" % (foodbank.slug),
+        }
+    if projection.wants("politics.urls"):
+        response_dict["politics"]["urls"] = {
+            "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
+            "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
+        }
+
+    if projection.wants("need"):
+        response_dict["need"] = {
             "id":foodbank.latest_need_id(),
-            "needs":foodbank.latest_need().clean_change_text(),
+            "needs":foodbank.published_need().clean_change_text(),
             "created":foodbank.latest_need_date(),
             "self":"https://www.givefood.org.uk/api/2/need/%s/" % (foodbank.latest_need_id()),
-        },
-        "nearby_foodbanks": nearby_foodbank_list,
-    }
+        }
 
-    return ApiResponse(response_dict, "foodbank", format)
+    return ApiResponse(response_dict, "foodbank", format, projection)
 
 
 @cache_page(60*20)
 def foodbank_search(request):
 
     format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
     lat_lng = request.GET.get("lat_lng")
     address = request.GET.get("address")
 
@@ -256,7 +300,7 @@ def foodbank_search(request):
         return HttpResponseBadRequest()
 
     if address and not lat_lng:
-        lat_lng = geocode(address)
+        lat_lng = lattlong_from_postcode(address) or geocode(address)
 
     if not is_uk(lat_lng):
         return HttpResponseBadRequest() 
@@ -279,10 +323,20 @@ def foodbank_search(request):
     )
     api_hit.save()
 
+    if projection.wants("needs"):
+        latest_needs = get_latest_needs([foodbank.name for foodbank in foodbanks])
+    else:
+        latest_needs = None
+
+    return ApiResponse(foodbank_search_data(foodbanks, latest_needs, projection), "foodbanks", format, projection)
+
+
+def foodbank_search_data(foodbanks, latest_needs, projection=ALL_FIELDS):
+
     response_list = []
 
     for foodbank in foodbanks:
-        response_list.append({
+        foodbank_dict = {
             "name":foodbank.name,
             "alt_name":foodbank.alt_name,
             "slug":foodbank.slug,
@@ -294,18 +348,6 @@ def foodbank_search(request):
             "lat_lng":foodbank.latt_long,
             "distance_m":int(foodbank.distance_m),
             "distance_mi":round(foodbank.distance_mi,2),
-            "needs": {
-                "needs":foodbank.latest_need().clean_change_text(),
-                "found":foodbank.latest_need().created,
-                "number":foodbank.latest_need().no_items(),
-            },
-            "urls": {
-                "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.slug),
-                "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.slug),
-                "homepage":foodbank.url,
-                "shopping_list":foodbank.shopping_list_url,
-                "map":"https://www.givefood.org.uk/needs/at/%s/map.png" % (foodbank.slug),
-            },
             "charity": {
                 "registration_id":foodbank.charity_number,
                 "register_url":foodbank.charity_register_url(),
@@ -317,28 +359,151 @@ def foodbank_search(request):
                 "mp_parl_id":foodbank.mp_parl_id,
                 "ward":foodbank.ward,
                 "district":foodbank.district,
-                "urls": {
-                    "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
-                    "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
-                },
             }
+        }
+
+        if projection.wants("urls"):
+            foodbank_dict["urls"] = {
+                "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.slug),
+                "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.slug),
+                "homepage":foodbank.url,
+                "shopping_list":foodbank.shopping_list_url,
+                "map":"https://www.givefood.org.uk/needs/at/%s/map.png" % (foodbank.slug),
+            }
+        if projection.wants("politics.urls"):
+            foodbank_dict["politics"]["urls"] = {
+                "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
+                "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (foodbank.parliamentary_constituency_slug),
+            }
+
+        if latest_needs is not None:
+            latest_need = latest_needs.get(foodbank.name)
+            foodbank_dict["needs"] = {
+                "needs":latest_need.clean_change_text(),
+                "found":latest_need.created,
+                "number":latest_need.no_items(),
+            }
+
+        response_list.append(foodbank_dict)
+
+    return response_list
+
+
+@csrf_exempt
+@require_POST
+def foodbank_search_batch(request):
+
+    format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
+
+    # Checked before the fields are projected, which is done per result
+    if format not in accceptable_formats("results"):
+        return HttpResponseBadRequest()
+
+    try:
+        queries = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    if not isinstance(queries, list) or not queries or len(queries) > SEARCH_BATCH_SIZE:
+        return HttpResponseBadRequest()
+    for query in queries:
+        if not isinstance(query, dict) or not (query.get("lat_lng") or query.get("address")):
+            return HttpResponseBadRequest()
+        if not all(isinstance(query.get(field) or "", basestring) for field in ["lat_lng", "address"]):
+            return HttpResponseBadRequest()
+
+    # Postcodes are found here, the rest of the addresses are geocoded
+    # all together
+    lat_lngs = []
+    for query in queries:
+        lat_lng = query.get("lat_lng")
+        if not lat_lng:
+            lat_lng = lattlong_from_postcode(query.get("address"))
+        lat_lngs.append(lat_lng)
+    geocoded = geocode_many([query.get("address") for query, lat_lng in zip(queries, lat_lngs) if not lat_lng])
+    lat_lngs = [lat_lng or geocoded[query.get("address")] for query, lat_lng in zip(queries, lat_lngs)]
+
+    found = []
+    for lat_lng in lat_lngs:
+        try:
+            found.append(is_uk(lat_lng))
+        except (ValueError, IndexError, AttributeError):
+            found.append(False)
+    results = iter(find_foodbanks_many([lat_lng for lat_lng, is_found in zip(lat_lngs, found) if is_found], 10))
+
+    api_hits = []
+    response_list = []
+    all_foodbanks = []
+
+    for query, lat_lng, is_found in zip(queries, lat_lngs, found):
+        if is_found:
+            foodbanks = next(results)
+            all_foodbanks.extend(foodbanks)
+
+            if query.get("address"):
+                query_type = "address"
+                query_text = query.get("address")
+            else:
+                query_type = "lattlong"
+                query_text = lat_lng
+
+            api_hits.append(ApiFoodbankSearch(
+                query_type = query_type,
+                query = query_text,
+                nearest_foodbank = foodbanks[0].distance_m,
+                latt_long = lat_lng,
+            ))
+        else:
+            foodbanks = None
+
+        response_list.append({
+            "lat_lng":query.get("lat_lng"),
+            "address":query.get("address"),
+            "foodbanks":foodbanks,
         })
 
-    return ApiResponse(response_list, "foodbanks", format)
+    # The search log, in one write
+    ApiFoodbankSearch.objects.bulk_create(api_hits)
+
+    if projection.wants("needs"):
+        latest_needs = get_latest_needs([foodbank.name for foodbank in all_foodbanks])
+    else:
+        latest_needs = None
+
+    for result in response_list:
+        if result["foodbanks"] is None:
+            result["error"] = "Not found in the UK"
+            result["foodbanks"] = []
+        else:
+            result["foodbanks"] = projection.apply(foodbank_search_data(result["foodbanks"], latest_needs, projection), format)
+
+    return ApiResponse(response_list, "results", format)
 
 
 @cache_control(public=True, max_age=3600)
 def locations(request):
 
     format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
+
+    # Paged when asked for, otherwise the whole prerendered list
+    if "cursor" in request.GET or "limit" in request.GET:
+        locations, next_cursor = get_snapshot_page(get_all_locations(), request.GET.get("cursor"), get_page_size(request))
+        response = ApiResponse(locations_data(locations, format, projection), "locations", format, projection)
+        return set_next_page_link(request, response, next_cursor)
+
+    return ApiSnapshotResponse(request, "locations", format, get_all_locations(), locations_data, projection)
+
+
+def locations_data(locations, format, projection=ALL_FIELDS):
 
-    locations = get_all_locations()
     response_list = []
 
     if format != "geojson":
         for location in locations:
 
-            response_list.append({
+            location_dict = {
                 "name":location.name,
                 "slug":location.slug,
                 "phone":location.phone_or_foodbank_phone(),
@@ -346,17 +511,10 @@ def locations(request):
                 "address":location.full_address(),
                 "postcode":location.postcode,
                 "lat_lng":location.latt_long,
-                "urls": {
-                    "html":"https://www.givefood.org.uk/needs/at/%s/%s/" % (location.foodbank_slug, location.slug)
-                },
                 "foodbank": {
                     "name":location.foodbank_name,
                     "slug":location.foodbank_slug,
                     "network":location.foodbank_network,
-                    "urls": {
-                        "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (location.foodbank_slug),
-                        "html":"https://www.givefood.org.uk/needs/at/%s/" % (location.foodbank_slug)
-                    },
                 },
                 "politics": {
                     "parliamentary_constituency":location.parliamentary_constituency,
@@ -365,12 +523,25 @@ def locations(request):
                     "mp_parl_id":location.mp_parl_id,
                     "ward":location.ward,
                     "district":location.district,
-                    "urls": {
-                        "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (location.parliamentary_constituency_slug),
-                        "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (location.parliamentary_constituency_slug),
-                    },
                 }
-            })
+            }
+
+            if projection.wants("urls"):
+                location_dict["urls"] = {
+                    "html":"https://www.givefood.org.uk/needs/at/%s/%s/" % (location.foodbank_slug, location.slug)
+                }
+            if projection.wants("foodbank.urls"):
+                location_dict["foodbank"]["urls"] = {
+                    "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (location.foodbank_slug),
+                    "html":"https://www.givefood.org.uk/needs/at/%s/" % (location.foodbank_slug)
+                }
+            if projection.wants("politics.urls"):
+                location_dict["politics"]["urls"] = {
+                    "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (location.parliamentary_constituency_slug),
+                    "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (location.parliamentary_constituency_slug),
+                }
+
+            response_list.append(location_dict)
     else:
 
         features = []
@@ -400,13 +571,14 @@ def locations(request):
             "features": features
         }
 
-    return ApiResponse(response_list, "locations", format)
+    return response_list
 
 
 @cache_page(60*20)
 def location_search(request):
 
     format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
     lat_lng = request.GET.get("lat_lng")
     address = request.GET.get("address")
 
@@ -414,7 +586,7 @@ def location_search(request):
         return HttpResponseBadRequest()
 
     if address and not lat_lng:
-        lat_lng = geocode(address)
+        lat_lng = lattlong_from_postcode(address) or geocode(address)
 
     if not is_uk(lat_lng):
         return HttpResponseBadRequest() 
@@ -436,17 +608,13 @@ def location_search(request):
     )
     api_hit.save()
 
+    if projection.wants("needs"):
+        latest_needs = get_latest_needs([location.get("foodbank_name") for location in locations])
+
     response_list = []
     for location in locations:
 
-        location_need = FoodbankChange.objects.filter(foodbank_name=location.get("foodbank_name"), published=True).latest("created")
-
-        if location.get("type") == "location":
-            html_url = "https://www.givefood.org.uk/needs/at/%s/%s/" % (slugify(location.get("foodbank_name")), slugify(location.get("name")))
-        if location.get("type") == "organisation":
-            html_url = "https://www.givefood.org.uk/needs/at/%s/" % (slugify(location.get("foodbank_name")))
-
-        response_list.append({
+        location_dict = {
             "type":location.get("type"),
             "name":location.get("name"),
             "lat_lng":location.get("lat_lng"),
@@ -458,15 +626,6 @@ def location_search(request):
                 "name":location.get("foodbank_name"),
                 "slug":str(slugify(location.get("foodbank_name"))),
                 "network":location.get("foodbank_network"),
-                "urls": {
-                    "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % slugify(location.get("foodbank_name")),
-                    "html":"https://www.givefood.org.uk/needs/at/%s/" % slugify(location.get("foodbank_name")),
-                }
-            },
-            "needs": {
-                "needs":location_need.clean_change_text(),
-                "number":location_need.no_items(),
-                "found":location_need.created,
             },
             "address":location.get("address"),
             "postcode":location.get("postcode"),
@@ -477,26 +636,54 @@ def location_search(request):
                 "mp_parl_id":location.get("mp_parl_id"),
                 "ward":location.get("ward"),
                 "district":location.get("district"),
-                "urls": {
-                    "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (location.get("parliamentary_constituency_slug")),
-                    "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (location.get("parliamentary_constituency_slug")),
-                },
             },
-            "urls": {
+        }
+
+        if projection.wants("urls"):
+            if location.get("type") == "location":
+                html_url = "https://www.givefood.org.uk/needs/at/%s/%s/" % (slugify(location.get("foodbank_name")), slugify(location.get("name")))
+            if location.get("type") == "organisation":
+                html_url = "https://www.givefood.org.uk/needs/at/%s/" % (slugify(location.get("foodbank_name")))
+            location_dict["urls"] = {
                 "html":html_url,
-            },
-        })
+            }
+        if projection.wants("foodbank.urls"):
+            location_dict["foodbank"]["urls"] = {
+                "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % slugify(location.get("foodbank_name")),
+                "html":"https://www.givefood.org.uk/needs/at/%s/" % slugify(location.get("foodbank_name")),
+            }
+        if projection.wants("politics.urls"):
+            location_dict["politics"]["urls"] = {
+                "self":"https://www.givefood.org.uk/api/2/constituency/%s/" % (location.get("parliamentary_constituency_slug")),
+                "html":"https://www.givefood.org.uk/needs/in/constituency/%s/" % (location.get("parliamentary_constituency_slug")),
+            }
+
+        if projection.wants("needs"):
+            location_need = latest_needs.get(location.get("foodbank_name"))
+            location_dict["needs"] = {
+                "needs":location_need.clean_change_text(),
+                "number":location_need.no_items(),
+                "found":location_need.created,
+            }
 
-    return ApiResponse(response_list, "locations", format)
+        response_list.append(location_dict)
+
+    return ApiResponse(response_list, "locations", format, projection)
 
 
 @cache_page(60*5)
 def needs(request):
 
     format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
 
     needs = FoodbankChange.objects.filter(published = True).order_by("-created")[:100]
 
+    return ApiResponse(needs_data(needs), "needs", format, projection)
+
+
+def needs_data(needs):
+
     response_list = []
 
     for need in needs:
@@ -516,7 +703,7 @@ def needs(request):
             "self":"https://www.givefood.org.uk/api/2/needs/%s/" % (need.need_id),
         })
 
-    return ApiResponse(response_list, "needs", format)
+    return response_list
 
 
 @cache_page(60*10)
@@ -543,31 +730,121 @@ def need(request, id):
     return ApiResponse(response_dict, "need", format)
 
 
+@cache_control(public=True, max_age=60)
+def changes(request):
+
+    format = request.GET.get("format", DEFAULT_FORMAT)
+    since = request.GET.get("since")
+    if since:
+        since = changes_cursor_datetime(since)
+    until = timezone.now() - timedelta(seconds = CHANGES_LAG)
+
+    changed = OrderedDict([
+        ("foodbanks", Foodbank.objects.all()),
+        ("locations", FoodbankLocation.objects.all()),
+        ("needs", FoodbankChange.objects.filter(published = True)),
+    ])
+    for kind, queryset in changed.items():
+        if since:
+            queryset = queryset.filter(modified__gt = since)
+        changed[kind] = list(queryset.filter(modified__lte = until).order_by("modified")[:CHANGES_LIMIT])
+
+    tombstones = Tombstone.objects.filter(created__lte = until)
+    if since:
+        tombstones = tombstones.filter(created__gt = since)
+    tombstones = list(tombstones.order_by("created")[:CHANGES_LIMIT])
+
+    # Where any kind has more changes than we return, stop every kind
+    # short of where it was cut off, so the next sync picks them all
+    # up from the same place
+    more = False
+    for objects, field_name in [(objects, "modified") for objects in changed.values()] + [(tombstones, "created")]:
+        if len(objects) == CHANGES_LIMIT:
+            more = True
+            last_change = getattr(objects[-1], field_name)
+            if since and last_change - timedelta(microseconds = 1) <= since:
+                until = min(until, last_change)
+            else:
+                until = min(until, last_change - timedelta(microseconds = 1))
+    if more:
+        for kind, objects in changed.items():
+            changed[kind] = [obj for obj in objects if obj.modified <= until]
+        tombstones = [tombstone for tombstone in tombstones if tombstone.created <= until]
+
+    builders = {
+        "foodbanks":lambda objects: foodbanks_data(objects, format),
+        "locations":lambda objects: locations_data(objects, format),
+        "needs":needs_data,
+    }
+    created = {}
+    updated = {}
+    for kind, objects in changed.items():
+        created[kind] = builders[kind]([obj for obj in objects if not since or obj.created > since])
+        updated[kind] = builders[kind]([obj for obj in objects if since and obj.created <= since])
+
+    deleted = {
+        "foodbanks":[tombstone.key for tombstone in tombstones if tombstone.kind == "foodbank"],
+        "locations":[tombstone.key for tombstone in tombstones if tombstone.kind == "location"],
+        "needs":[tombstone.key for tombstone in tombstones if tombstone.kind == "need"],
+    }
+
+    response_dict = {
+        "since":since or None,
+        "until":until,
+        "next":changes_cursor(until),
+        "more":more,
+        "created":created,
+        "updated":updated,
+        "deleted":deleted,
+    }
+
+    return ApiResponse(response_dict, "changes", format)
+
+
 @cache_page(60*20)
 def constituency(request, slug):
 
     format = request.GET.get("format", DEFAULT_FORMAT)
+    projection = Projection(request.GET.get("fields"))
+    simplify = request.GET.get("simplify")
+    precision = request.GET.get("precision")
+
+    if simplify and simplify not in BOUNDARY_SIMPLIFY_TOLERANCES:
+        return HttpResponseBadRequest()
+    if precision:
+        try:
+            precision = int(precision)
+        except ValueError:
+            return HttpResponseBadRequest()
+        if not 0 <= precision <= 15:
+            return HttpResponseBadRequest()
+    else:
+        precision = None
+
     constituency = get_object_or_404(ParliamentaryConstituency, slug = slug)
-    foodbanks = constituency.foodbanks()
+    if format == "geojson" or projection.wants("foodbanks"):
+        foodbanks = constituency.foodbanks()
+    else:
+        foodbanks = []
 
     if format != "geojson":
         foodbank_list = []
         for foodbank in foodbanks:
-            foodbank_list.append(
-                {
-                    "name":foodbank.get("name"),
-                    "slug":foodbank.get("slug"),
-                    "lat_lng":foodbank.get("lat_lng"),
-                    "needs":foodbank.get("needs").clean_change_text(),
-                    "urls": {
-                        "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.get("slug")),
-                        "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.get("slug")),
-                        "homepage":foodbank.get("url"),
-                        "shopping_list":foodbank.get("shopping_list_url"),
-                        "map":"https://www.givefood.org.uk/needs/at/%s/map.png" % (foodbank.get("slug")),
-                    },
+            foodbank_dict = {
+                "name":foodbank.get("name"),
+                "slug":foodbank.get("slug"),
+                "lat_lng":foodbank.get("lat_lng"),
+                "needs":foodbank.get("needs").clean_change_text(),
+            }
+            if projection.wants("foodbanks.urls"):
+                foodbank_dict["urls"] = {
+                    "self":"https://www.givefood.org.uk/api/2/foodbank/%s/" % (foodbank.get("slug")),
+                    "html":"https://www.givefood.org.uk/needs/at/%s/" % (foodbank.get("slug")),
+                    "homepage":foodbank.get("url"),
+                    "shopping_list":foodbank.get("shopping_list_url"),
+                    "map":"https://www.givefood.org.uk/needs/at/%s/map.png" % (foodbank.get("slug")),
                 }
-            )
+            foodbank_list.append(foodbank_dict)
 
         response_dict = {
             "name":constituency.name,
@@ -600,11 +877,11 @@ def constituency(request, slug):
                 }
             )
 
-        features.append(constituency.boundary_geojson_dict())
+        features.append(constituency.boundary_geojson_dict(simplify, precision))
 
         response_dict = {
             "type": "FeatureCollection",
             "features": features,
         }
 
-    return ApiResponse(response_dict, "constituency", format)
+    return ApiResponse(response_dict, "constituency", format, projection)
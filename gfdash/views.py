@@ -66,7 +66,7 @@ def dash_most_requested_items(request):
     for recent_foodbank in recent_foodbanks:
 
         # Find need text
-        need_text = recent_foodbank.latest_need().change_text
+        need_text = recent_foodbank.latest_need_text()
 
         # Don't count the need if it's a keyword
         if not need_text in invalid_text:
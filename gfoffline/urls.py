@@ -7,4 +7,7 @@ urlpatterns = (
     url(r'^search/saver/$', offline_search_saver, name="offline_search_saver"),
     url(r'^search/hydrate/$', offline_fire_search_hydrate, name="offline_fire_search_hydrate"),
     url(r'^crawl_articles/$', offline_crawl_articles, name="offline_crawl_articles"),
+    url(r'^order_totals/$', offline_order_totals, name="offline_order_totals"),
+    url(r'^location_timestamps/$', offline_location_timestamps, name="offline_location_timestamps"),
+    url(r'^reconcile_counters/$', offline_reconcile_counters, name="offline_reconcile_counters"),
 )
\ No newline at end of file
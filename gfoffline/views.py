@@ -4,22 +4,22 @@ import feedparser
 from datetime import datetime
 from time import mktime
 
-from google.appengine.api import urlfetch, memcache
+from google.appengine.api import urlfetch
 from google.appengine.ext import deferred
 from django.http import HttpResponse
 from django.db import IntegrityError
 
-from givefood.models import Foodbank, FoodbankLocation, ApiFoodbankSearch, FoodbankArticle
-from givefood.const.general import FB_MC_KEY, LOC_MC_KEY
+from givefood.models import Foodbank, FoodbankLocation, OrderItem, ApiFoodbankSearch, FoodbankArticle, FoodbankChange, FoodbankSubscriber
+from givefood.func import get_snapshot, constituency_from_lattlong, reconcile_counter, counter_changes, country_counter, get_shard_count
+from givefood.const.general import FB_MC_KEY, LOC_MC_KEY, ITEMS_MC_KEY, FB_GEN_MC_KEY, LOC_GEN_MC_KEY, ITEMS_GEN_MC_KEY, SNAPSHOT_REFRESH_AGE, COUNTRIES, COUNTER_NAMES
 
 
 def offline_precacher(request):
 
-    all_locations = FoodbankLocation.objects.all()
-    memcache.add(LOC_MC_KEY, all_locations, 3600)
-
-    all_foodbanks = Foodbank.objects.all()
-    memcache.add(FB_MC_KEY, all_foodbanks, 3600)
+    # Rebuild snapshots before they expire, so requests never have to
+    get_snapshot(LOC_MC_KEY, LOC_GEN_MC_KEY, FoodbankLocation, SNAPSHOT_REFRESH_AGE)
+    get_snapshot(FB_MC_KEY, FB_GEN_MC_KEY, Foodbank, SNAPSHOT_REFRESH_AGE)
+    get_snapshot(ITEMS_MC_KEY, ITEMS_GEN_MC_KEY, OrderItem, SNAPSHOT_REFRESH_AGE)
 
     return HttpResponse("OK")
 
@@ -83,11 +83,61 @@ def hydrate_search_log(search):
             search.msoa = pc_api_json["result"][0]["msoa"]
             search.parliamentary_constituency = pc_api_json["result"][0]["parliamentary_constituency"]
 
+        # The constituency the search is actually in, rather than that of
+        # the nearest postcode which can be up to 10km away
+        search.parliamentary_constituency = constituency_from_lattlong(search.latt_long) or search.parliamentary_constituency
+
         search.save()
 
     return HttpResponse("OK")
 
 
+def offline_order_totals(request):
+
+    # Recount every food bank's order totals, for backfilling them
+    foodbanks = Foodbank.objects.all()
+    for foodbank in foodbanks:
+        deferred.defer(foodbank.recompute_order_totals)
+
+    return HttpResponse("OK")
+
+
+def offline_location_timestamps(request):
+
+    # Backfill created and modified on locations from before they were kept
+    locations = FoodbankLocation.objects.all()
+    for location in locations:
+        if not location.created or not location.modified:
+            deferred.defer(location.fill_timestamps)
+
+    return HttpResponse("OK")
+
+
+def offline_reconcile_counters(request):
+
+    # Correct any drift in the counters, overall and for each country.
+    # Also backfills them the first time. Food banks' order totals are
+    # kept by their orders, so aren't recounted here.
+    foodbank_countries = dict((foodbank.pk, foodbank.country) for foodbank in Foodbank.objects.all())
+
+    totals = dict((name, 0) for name in COUNTER_NAMES)
+    totals.update((country_counter(name, country), 0) for name in COUNTER_NAMES for country in COUNTRIES)
+    # What the counters were before counting, to tell if they changed
+    # while counting
+    shard_counts = dict((name, get_shard_count(name)) for name in totals)
+    for need in FoodbankChange.objects.all():
+        for name, count in counter_changes({"needs":1, "need_items":need.no_items()}, foodbank_countries.get(need.foodbank_id)).items():
+            totals[name] = totals[name] + count
+    for subscriber in FoodbankSubscriber.objects.filter(confirmed = True):
+        for name, count in counter_changes({"subscriptions":1}, foodbank_countries.get(subscriber.foodbank_id)).items():
+            totals[name] = totals[name] + count
+
+    for name, count in totals.items():
+        reconcile_counter(name, count, shard_counts[name])
+
+    return HttpResponse("OK")
+
+
 def offline_crawl_articles(request):
 
     foodbanks_with_rss = Foodbank.objects.filter(rss_url__isnull=False)
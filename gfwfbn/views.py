@@ -15,7 +15,7 @@ from google.appengine.api import urlfetch
 from session_csrf import anonymous_csrf
 
 from givefood.models import Foodbank, FoodbankLocation, ParliamentaryConstituency, FoodbankChange, FoodbankSubscriber
-from givefood.func import get_all_constituencies, get_all_foodbanks, get_all_locations, find_foodbanks, geocode, find_locations, admin_regions_from_postcode, get_cred, send_email, post_to_email
+from givefood.func import get_all_constituencies, get_all_foodbanks, get_all_locations, find_foodbanks, geocode, lattlong_from_postcode, find_locations, admin_regions_from_postcode, constituency_from_lattlong, get_cred, send_email, post_to_email, get_latest_needs
 from gfwfbn.forms import NeedForm, ContactForm, FoodbankLocationForm, LocationLocationForm
 
 
@@ -32,14 +32,15 @@ def public_what_food_banks_need(request):
     if where_from != "trusselltrust":
 
         if address and not lattlong:
-            lattlong = geocode(address)
+            lattlong = lattlong_from_postcode(address) or geocode(address)
 
         if lattlong:
             location_results = find_locations(lattlong, 10)
+            latest_needs = get_latest_needs([location.get("foodbank_name") for location in location_results])
 
             for location in location_results:
-                location_need = FoodbankChange.objects.filter(foodbank_name=location.get("foodbank_name"), published=True).latest("created")
-                location["needs"] = location_need.change_text
+                location_need = latest_needs.get(location.get("foodbank_name"))
+                location.needs = location_need.change_text
 
     gmap_key = get_cred("gmap_key")
 
@@ -152,8 +153,10 @@ def public_wfbn_constituencies(request):
 
     postcode = request.GET.get("postcode", None)
     if postcode:
-        admin_regions = admin_regions_from_postcode(postcode)
-        parl_con = admin_regions.get("parliamentary_constituency", None)
+        parl_con = constituency_from_lattlong(lattlong_from_postcode(postcode))
+        if not parl_con:
+            admin_regions = admin_regions_from_postcode(postcode)
+            parl_con = admin_regions.get("parliamentary_constituency", None)
         if parl_con:
             return HttpResponseRedirect(reverse("public_wfbn_constituency", kwargs={"slug":slugify(parl_con)}))
 
@@ -175,6 +178,11 @@ def public_wfbn_constituency(request, slug):
     foodbanks = Foodbank.objects.filter(parliamentary_constituency_slug = slug)
     locations = FoodbankLocation.objects.filter(parliamentary_constituency_slug = slug)
 
+    latest_needs = get_latest_needs(
+        [foodbank.name for foodbank in foodbanks] + [location.foodbank_name for location in locations]
+    )
+
+    gmap_key = get_cred("gmap_key")
     constituency_foodbanks = []
 
     for foodbank in foodbanks:
@@ -186,8 +194,8 @@ def public_wfbn_constituency(request, slug):
             "mp_party":foodbank.mp_party,
             "mp_parl_id":foodbank.mp_parl_id,
             "latt_long":foodbank.latt_long,
-            "needs":foodbank.latest_need(),
-            "gmap_key":get_cred("gmap_key"),
+            "needs":latest_needs.get(foodbank.name),
+            "gmap_key":gmap_key,
             "url":"/needs/at/%s/" % (foodbank.slug)
         })
 
@@ -200,7 +208,7 @@ def public_wfbn_constituency(request, slug):
             "mp_party":location.mp_party,
             "mp_parl_id":location.mp_parl_id,
             "latt_long":location.latt_long,
-            "needs":location.latest_need(),
+            "needs":latest_needs.get(location.foodbank_name),
             "url":"/needs/at/%s/%s/" % (location.foodbank_slug, location.slug)
         })
 
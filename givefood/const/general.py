@@ -40,6 +40,70 @@ FB_MC_KEY = "all_foodbanks"
 LOC_MC_KEY = "all_locations"
 ITEMS_MC_KEY = "all_items"
 
+# Generations of cached data, bumped whenever an object of that kind changes
+FB_GEN_MC_KEY = "generation_foodbanks"
+LOC_GEN_MC_KEY = "generation_locations"
+ITEMS_GEN_MC_KEY = "generation_items"
+
+# Bump when the layout of cached snapshots changes
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_TTL = 3600
+SNAPSHOT_STALE_TTL = 3600 #Kept this much longer, to serve while rebuilding
+SNAPSHOT_REFRESH_AGE = 60*40 #Precacher rebuilds snapshots older than this
+SNAPSHOT_LEASE_TIME = 60
+SNAPSHOT_WAIT_INTERVAL = 0.1
+SNAPSHOT_WAIT_ATTEMPTS = 30
+SNAPSHOT_CHUNK_SIZE = 950000 #Bytes, under memcache's 1MB limit
+
+GEOCODE_CACHE_SIZE = 1000
+GEOCODE_CACHE_TTL = 60*60*24*90
+GEOCODE_CACHE_FAILED_TTL = 60*60*24
+GEOCODE_STATS_MC_KEYS = {
+    "instance_hit":"geocode_instance_hits",
+    "datastore_hit":"geocode_datastore_hits",
+    "miss":"geocode_misses",
+}
+GEOCODE_BATCH_SIZE = 30 #Addresses per datastore IN query
+GEOCODE_CONCURRENCY = 10 #URL Fetch calls at once
+
+SEARCH_BATCH_SIZE = 500
+
+WEIGHT_CACHE_SIZE = 10000
+
+COUNTER_SHARDS = 20
+COUNTER_MC_KEY = "counter_%s"
+COUNTER_CACHE_TTL = 3600
+COUNTER_NAMES = [
+    "needs",
+    "need_items",
+    "subscriptions",
+]
+
+POSTCODES_DATA_DIR = "./givefood/data/postcodes"
+PARLCON_BOUNDARIES_FILE = "./givefood/data/parlcon.geojson"
+
+# Douglas-Peucker tolerances for constituency boundaries, in degrees
+BOUNDARY_SIMPLIFY_TOLERANCES = {
+    "high":0.0001,
+    "medium":0.0005,
+    "low":0.002,
+}
+BOUNDARY_CACHE_SIZE = 200
+
+CRED_CACHE_TTL = 60
+
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+ADMIN_PAGE_SIZE = 200
+
+# Rendered API list responses kept on each instance
+API_SNAPSHOT_CACHE_SIZE = 8
+
+# Changes newer than CHANGES_LAG seconds are left for the next sync, as
+# datastore queries can take a moment to see them
+CHANGES_LIMIT = 500
+CHANGES_LAG = 60
+
 RICK_ASTLEY = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
 
 API_DOMAIN = "https://www.givefood.org.uk"
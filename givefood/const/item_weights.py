@@ -0,0 +1,23 @@
+# Weights in grams (or ml) for get_weight
+
+# Items whose weight can't be told from their name
+ITEM_WEIGHTS = {
+    "Tesco Mince Pies 6 Pack":324,
+    "Tesco Lattice Mince Pies 6 Pack":324,
+}
+
+# Items sold by the pack, by the end of their name
+PACK_WEIGHTS = {
+    "5 Pack":750, # Bananas
+}
+
+# Sizes at the end of names, such as 400G, 1.5kg, 6X1l or 4 X 410G
+UNIT_WEIGHTS = {
+    "g":1,
+    "kg":1000,
+    "ml":1,
+    "cl":10,
+    "l":1000,
+    "litre":1000,
+    "litres":1000,
+}
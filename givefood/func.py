@@ -1,19 +1,29 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import re, logging, operator, json, urllib, difflib
+import os, sys, re, logging, json, urllib, difflib, heapq, time, threading, csv, hashlib, zlib, base64, calendar, random
+from datetime import datetime, timedelta
+import cPickle as pickle
 from math import radians, cos, sin, asin, sqrt
 from collections import OrderedDict 
+from array import array
 
 import facebook, twitter
 
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.api import datastore_errors
 
 from django.template.defaultfilters import truncatechars
+from django.db import IntegrityError
+from django.core.exceptions import SuspiciousOperation, ValidationError
+from django.utils import timezone
+from djangae.db.utils import get_cursor, set_cursor
+from djangae.db import transaction
 
-from givefood.const.general import FB_MC_KEY, LOC_MC_KEY, ITEMS_MC_KEY
+from givefood.const.general import FB_MC_KEY, LOC_MC_KEY, ITEMS_MC_KEY, FB_GEN_MC_KEY, LOC_GEN_MC_KEY, ITEMS_GEN_MC_KEY, SNAPSHOT_FORMAT, SNAPSHOT_TTL, SNAPSHOT_STALE_TTL, SNAPSHOT_LEASE_TIME, SNAPSHOT_WAIT_INTERVAL, SNAPSHOT_WAIT_ATTEMPTS, SNAPSHOT_CHUNK_SIZE, GEOCODE_CACHE_SIZE, GEOCODE_CACHE_TTL, GEOCODE_CACHE_FAILED_TTL, GEOCODE_STATS_MC_KEYS, GEOCODE_BATCH_SIZE, GEOCODE_CONCURRENCY, POSTCODES_DATA_DIR, PARLCON_BOUNDARIES_FILE, BOUNDARY_SIMPLIFY_TOLERANCES, BOUNDARY_CACHE_SIZE, CRED_CACHE_TTL, API_PAGE_SIZE, API_MAX_PAGE_SIZE, WEIGHT_CACHE_SIZE, COUNTER_SHARDS, COUNTER_MC_KEY, COUNTER_CACHE_TTL
 from givefood.const.parlcon_mp import parlcon_mp
+from givefood.const.item_weights import ITEM_WEIGHTS, PACK_WEIGHTS, UNIT_WEIGHTS
 from givefood.const.parlcon_party import parlcon_party
 
 
@@ -21,11 +31,7 @@ def get_all_foodbanks():
 
     from models import Foodbank
 
-    all_foodbanks = memcache.get(FB_MC_KEY)
-    if all_foodbanks is None:
-        all_foodbanks = Foodbank.objects.all()
-        memcache.add(FB_MC_KEY, all_foodbanks, 3600)
-    return all_foodbanks
+    return get_snapshot(FB_MC_KEY, FB_GEN_MC_KEY, Foodbank)
 
 
 def get_all_open_foodbanks():
@@ -43,17 +49,322 @@ def get_all_locations():
 
     from models import FoodbankLocation
 
-    all_locations = memcache.get(LOC_MC_KEY)
-    if all_locations is None:
-        all_locations = FoodbankLocation.objects.all()
-        memcache.add(LOC_MC_KEY, all_locations, 3600)
-    return all_locations
+    return get_snapshot(LOC_MC_KEY, LOC_GEN_MC_KEY, FoodbankLocation)
+
+
+def get_generations(gen_mc_keys):
+    """
+    The current generation of each kind of cached data. A generation
+    goes up every time an object of its kind is saved or deleted, so
+    anything derived from that kind can be cached under it and never
+    needs deleting.
+    """
+
+    generations = memcache.get_multi(gen_mc_keys)
+    for gen_mc_key in gen_mc_keys:
+        if gen_mc_key not in generations:
+            generation = new_generation()
+            if not memcache.add(gen_mc_key, generation):
+                generation = memcache.get(gen_mc_key) or generation
+            generations[gen_mc_key] = generation
+    return generations
+
+
+def get_generation(gen_mc_key):
+
+    return get_generations([gen_mc_key])[gen_mc_key]
+
+
+def bump_generation(gen_mc_key):
+
+    if memcache.incr(gen_mc_key) is None:
+        memcache.set(gen_mc_key, new_generation())
+
+
+def new_generation():
+
+    # In milliseconds, so a generation lost from memcache starts again
+    # above where it was
+    return int(time.time() * 1000)
+
+
+# Snapshots loaded on this instance, keyed by memcache key.
+# Each is stored as (generation, header, objects).
+_snapshots = {}
+
+
+def get_snapshot(mc_key, gen_mc_key, model, max_age = SNAPSHOT_TTL):
+    """
+    Every object of a model, from a snapshot shared through memcache.
+
+    The snapshot is the field values of each object as plain tuples,
+    pickled, compressed and split into chunks to fit memcache's value
+    limit. It's stored under the model's current generation, with a
+    small header naming its chunks. Once loaded the objects are kept on
+    this instance, so most requests only fetch the generation.
+
+    When a snapshot is missing or older than max_age, one request takes
+    a lease and rebuilds it. Meanwhile everyone else carries on with the
+    last snapshot there was, so a rebuild is one datastore query however
+    busy we are.
+
+    The objects returned are shared between requests and mustn't be
+    changed.
+    """
+
+    generation = get_generation(gen_mc_key)
+    now = time.time()
+
+    cached_snapshot = _snapshots.get(mc_key)
+    if cached_snapshot and cached_snapshot[0] == generation and now - cached_snapshot[1]["built"] < max_age:
+        return cached_snapshot[2]
+
+    snapshot_key = "%s_%s" % (mc_key, generation)
+    field_names = snapshot_field_names(model)
+
+    objects = None
+    header = get_snapshot_header(snapshot_key, field_names)
+    if header:
+        if cached_snapshot and cached_snapshot[1]["build"] == header["build"]:
+            objects = cached_snapshot[2]
+        else:
+            objects = load_snapshot(snapshot_key, model, header)
+        if objects is not None:
+            _snapshots[mc_key] = (generation, header, objects)
+            if now - header["built"] < max_age:
+                return objects
+
+    lease_key = "%s_lease" % (snapshot_key)
+    if memcache.add(lease_key, 1, SNAPSHOT_LEASE_TIME):
+        try:
+            header, objects = build_snapshot(snapshot_key, model)
+            memcache.set("%s_latest" % (mc_key), (generation, snapshot_key))
+        finally:
+            memcache.delete(lease_key)
+        _snapshots[mc_key] = (generation, header, objects)
+        return objects
+
+    # Someone else is rebuilding it
+    if objects is not None:
+        return objects
+
+    stale_snapshot = cached_snapshot or get_latest_snapshot(mc_key, model, field_names)
+    if stale_snapshot:
+        _snapshots[mc_key] = stale_snapshot
+        return stale_snapshot[2]
+
+    # There's nothing to fall back on, so wait for them
+    for attempt in range(SNAPSHOT_WAIT_ATTEMPTS):
+        time.sleep(SNAPSHOT_WAIT_INTERVAL)
+        header = get_snapshot_header(snapshot_key, field_names)
+        if header:
+            objects = load_snapshot(snapshot_key, model, header)
+            if objects is not None:
+                _snapshots[mc_key] = (generation, header, objects)
+                return objects
+
+    header, objects = build_snapshot(snapshot_key, model)
+    _snapshots[mc_key] = (generation, header, objects)
+    return objects
+
+
+def get_snapshot_header(snapshot_key, field_names):
+
+    header = memcache.get(snapshot_key)
+    if header and header.get("format") == SNAPSHOT_FORMAT and header.get("fields") == field_names:
+        return header
+    return None
+
+
+def get_latest_snapshot(mc_key, model, field_names):
+
+    latest = memcache.get("%s_latest" % (mc_key))
+    if not latest:
+        return None
+
+    generation, snapshot_key = latest
+    header = get_snapshot_header(snapshot_key, field_names)
+    if not header:
+        return None
+
+    objects = load_snapshot(snapshot_key, model, header)
+    if objects is None:
+        return None
+    return (generation, header, objects)
+
+
+def snapshot_field_names(model):
+
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def snapshot_chunk_keys(snapshot_key, build, chunks):
+
+    return ["%s_%s_%d" % (snapshot_key, build, chunk) for chunk in range(chunks)]
+
+
+def load_snapshot(snapshot_key, model, header):
+
+    chunk_keys = snapshot_chunk_keys(snapshot_key, header["build"], header["chunks"])
+    chunks = memcache.get_multi(chunk_keys)
+    if len(chunks) != len(chunk_keys):
+        # Some of it has been evicted
+        return None
+
+    rows = pickle.loads(zlib.decompress("".join(chunks[chunk_key] for chunk_key in chunk_keys)))
+    return snapshot_objects(model, header["fields"], rows)
+
+
+def build_snapshot(snapshot_key, model):
+
+    logging.info("Building %s snapshot" % (snapshot_key))
+
+    built = time.time()
+    field_names = snapshot_field_names(model)
+    # In key order, which get_snapshot_page relies on
+    objects = tuple(model.objects.order_by("pk"))
+    rows = [tuple(getattr(obj, field_name) for field_name in field_names) for obj in objects]
+
+    # Each build's chunks are kept apart, so one being replaced is never
+    # read half overwritten
+    data = zlib.compress(pickle.dumps(rows, pickle.HIGHEST_PROTOCOL))
+    build = "%f" % (built)
+    chunk_keys = snapshot_chunk_keys(snapshot_key, build, -(-len(data) // SNAPSHOT_CHUNK_SIZE))
+
+    # Kept past max_age, to be served while the next one is built
+    memcache.set_multi(dict(
+        (chunk_key, data[chunk * SNAPSHOT_CHUNK_SIZE:(chunk + 1) * SNAPSHOT_CHUNK_SIZE])
+        for chunk, chunk_key in enumerate(chunk_keys)
+    ), SNAPSHOT_TTL + SNAPSHOT_STALE_TTL)
+
+    header = {
+        "format":SNAPSHOT_FORMAT,
+        "build":build,
+        "built":built,
+        "fields":field_names,
+        "chunks":len(chunk_keys),
+    }
+    # Chunks go in before the header that points to them
+    memcache.set(snapshot_key, header, SNAPSHOT_TTL + SNAPSHOT_STALE_TTL)
+
+    return header, objects
+
+
+def snapshot_objects(model, field_names, rows):
+
+    db = model.objects.db
+    return tuple(model.from_db(db, field_names, row) for row in rows)
+
+
+def get_page(queryset, cursor, page_size):
+    """
+    A page of a queryset and the cursor for the next one, which is None
+    after the last page. The datastore carries on from the cursor rather
+    than skipping the rows before it, so later pages cost the same as
+    the first.
+    """
+
+    try:
+        if cursor:
+            queryset = set_cursor(queryset, start = cursor)
+    except datastore_errors.BadValueError:
+        raise SuspiciousOperation("Invalid cursor")
+
+    queryset = queryset[:page_size]
+    objects = list(queryset)
+
+    next_cursor = None
+    if len(objects) == page_size:
+        next_cursor = get_cursor(queryset)
+
+    return objects, next_cursor
+
+
+def get_snapshot_page(objects, cursor, page_size):
+    """
+    A page of a snapshot and the cursor for the next one. Cursors hold
+    the key of the last object on the page before, so paging carries on
+    in the right place when the snapshot is rebuilt in between.
+    Snapshots are already in key order, so the page is found by binary
+    search.
+    """
+
+    start = 0
+
+    if cursor and objects:
+        try:
+            last_pk = objects[0]._meta.pk.to_python(base64.urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError, ValidationError):
+            raise SuspiciousOperation("Invalid cursor")
+        # The first object after last_pk
+        end = len(objects)
+        while start < end:
+            middle = (start + end) // 2
+            if objects[middle].pk <= last_pk:
+                start = middle + 1
+            else:
+                end = middle
+
+    page = objects[start:start + page_size]
+
+    next_cursor = None
+    if start + page_size < len(objects):
+        next_cursor = base64.urlsafe_b64encode(str(page[-1].pk))
+
+    return page, next_cursor
+
+
+def changes_cursor(when):
+
+    return str(calendar.timegm(when.utctimetuple()) * 1000000 + when.microsecond)
+
+
+def changes_cursor_datetime(cursor):
+
+    try:
+        return datetime(1970, 1, 1, tzinfo = timezone.utc) + timedelta(microseconds = int(cursor))
+    except (ValueError, OverflowError):
+        raise SuspiciousOperation("Invalid cursor")
+
+
+def get_page_size(request, default = API_PAGE_SIZE, maximum = API_MAX_PAGE_SIZE):
+
+    try:
+        page_size = int(request.GET.get("limit", default))
+    except ValueError:
+        raise SuspiciousOperation("Invalid limit")
+
+    return max(1, min(page_size, maximum))
+
+
+def next_page_url(request, next_cursor):
+
+    params = request.GET.copy()
+    params["cursor"] = next_cursor
+    return "%s?%s" % (request.path, params.urlencode())
+
+
+def set_next_page_link(request, response, next_cursor):
+
+    if next_cursor:
+        response["Link"] = '<%s>; rel="next"' % (request.build_absolute_uri(next_page_url(request, next_cursor)))
+    return response
+
+
+# Constituency names, with the snapshots they came from
+_constituencies = None
 
 
 def get_all_constituencies():
 
+    global _constituencies
+
     foodbanks = get_all_foodbanks()
     locations = get_all_locations()
+
+    if _constituencies and _constituencies[0] is foodbanks and _constituencies[1] is locations:
+        return _constituencies[2]
+
     constituencies = set()
 
     for foodbank in foodbanks:
@@ -66,8 +377,26 @@ def get_all_constituencies():
 
     constituencies = sorted(constituencies)
 
+    _constituencies = (foodbanks, locations, constituencies)
     return constituencies
 
+def get_latest_needs(foodbank_names):
+    """
+    The latest published need for each of the named food banks, as a
+    dict keyed by name. These come from the copy of the need kept on
+    each food bank, so no needs have to be looked up.
+    """
+
+    foodbank_names = set(foodbank_names)
+
+    latest_needs = {}
+    for foodbank in get_all_foodbanks():
+        if foodbank.name in foodbank_names:
+            latest_needs[foodbank.name] = foodbank.published_need()
+
+    return latest_needs
+
+
 def diff_html(a,b):
 
     the_diff = list(difflib.unified_diff(a, b, n=999))
@@ -88,12 +417,88 @@ def diff_html(a,b):
 
 def geocode(address):
 
+    cache_key = normalise_address(address)
+    lattlong = get_cached_geocode(cache_key)
+    if lattlong:
+        return lattlong
+
     logging.info("Geocode %s" % (address))
+    count_geocode_stat("miss")
+
+    address_api_result = urlfetch.fetch(geocode_api_url(address))
+    return geocode_from_api_result(cache_key, address_api_result)
+
+
+def geocode_many(addresses):
+    """
+    geocode for a lot of addresses at once, as a dict keyed by address.
+    Cached answers are looked up together and the rest are asked of the
+    API GEOCODE_CONCURRENCY at a time, rather than one after another.
+    """
+
+    from models import GeocodeResult
+
+    cache_keys = dict((address, normalise_address(address)) for address in set(addresses))
+    lattlongs = {}
+
+    missing = set()
+    for cache_key in set(cache_keys.values()):
+        lattlong = get_remembered_geocode(cache_key)
+        if lattlong:
+            lattlongs[cache_key] = lattlong
+        else:
+            missing.add(cache_key)
+    if len(lattlongs):
+        count_geocode_stat("instance_hit", len(lattlongs))
+
+    missing = list(missing)
+    now = time.time()
+    datastore_hits = 0
+    for start in range(0, len(missing), GEOCODE_BATCH_SIZE):
+        for geocode_result in GeocodeResult.objects.filter(address__in = missing[start:start + GEOCODE_BATCH_SIZE]):
+            expires = geocode_result.expires()
+            if expires > now:
+                remember_geocode(geocode_result.address, geocode_result.latt_long, expires)
+                lattlongs[geocode_result.address] = geocode_result.latt_long
+                datastore_hits += 1
+    if datastore_hits:
+        count_geocode_stat("datastore_hit", datastore_hits)
+
+    # Any address will do for those that normalise the same
+    to_fetch = dict((cache_key, address) for address, cache_key in cache_keys.items() if cache_key not in lattlongs)
+    if to_fetch:
+        logging.info("Geocode %s addresses" % (len(to_fetch)))
+        count_geocode_stat("miss", len(to_fetch))
+
+    to_fetch = to_fetch.items()
+    for start in range(0, len(to_fetch), GEOCODE_CONCURRENCY):
+        rpcs = []
+        for cache_key, address in to_fetch[start:start + GEOCODE_CONCURRENCY]:
+            rpc = urlfetch.create_rpc()
+            urlfetch.make_fetch_call(rpc, geocode_api_url(address))
+            rpcs.append((cache_key, rpc))
+        for cache_key, rpc in rpcs:
+            try:
+                address_api_result = rpc.get_result()
+            except urlfetch.Error:
+                logging.warning("Geocode failed for %s" % (cache_key))
+                lattlongs[cache_key] = "0,0"
+                continue
+            lattlongs[cache_key] = geocode_from_api_result(cache_key, address_api_result)
+
+    return dict((address, lattlongs[cache_key]) for address, cache_key in cache_keys.items())
+
+
+def geocode_api_url(address):
 
     gmap_geocode_key = get_cred("gmap_geocode_key")
+    return "https://maps.googleapis.com/maps/api/geocode/json?key=%s&address=%s" % (gmap_geocode_key, urllib.quote(address.encode('utf8')))
+
+
+def geocode_from_api_result(cache_key, address_api_result):
+
+    lattlong = "0,0"
 
-    address_api_url = "https://maps.googleapis.com/maps/api/geocode/json?key=%s&address=%s" % (gmap_geocode_key, urllib.quote(address.encode('utf8')))
-    address_api_result = urlfetch.fetch(address_api_url)
     if address_api_result.status_code == 200:
         try:
             address_result_json = json.loads(address_api_result.content)
@@ -103,28 +508,296 @@ def geocode(address):
             )
         except:
             lattlong = "0,0"
+
+        # Only cache answers from the API, not errors from reaching it
+        cache_geocode(cache_key, lattlong)
+
     return lattlong
 
 
+def normalise_address(address):
+    """
+    The form of an address used as a geocode cache key, so that the same
+    place typed differently shares a key. Case, whitespace and stray
+    commas are ignored, and postcodes are spaced the standard way.
+    """
+
+    address = " ".join(address.upper().replace(",", " , ").split())
+    address = address.replace(" ,", ",").strip(", ")
+    address = re.sub(r"\b([A-Z]{1,2}[0-9][0-9A-Z]?) ?([0-9][A-Z]{2})\b", r"\1 \2", address)
+    return address
+
+
+# Geocode results cached on this instance, least recently used first.
+# Values are (lattlong, expiry time).
+_geocode_cache = OrderedDict()
+_geocode_cache_lock = threading.Lock()
+
+
+def get_cached_geocode(cache_key):
+
+    from models import GeocodeResult
+
+    lattlong = get_remembered_geocode(cache_key)
+    if lattlong:
+        count_geocode_stat("instance_hit")
+        return lattlong
+
+    try:
+        geocode_result = GeocodeResult.objects.get(address = cache_key)
+    except GeocodeResult.DoesNotExist:
+        return None
+
+    expires = geocode_result.expires()
+    if expires <= time.time():
+        return None
+
+    remember_geocode(cache_key, geocode_result.latt_long, expires)
+    count_geocode_stat("datastore_hit")
+    return geocode_result.latt_long
+
+
+def cache_geocode(cache_key, lattlong):
+
+    from models import GeocodeResult
+
+    if lattlong == "0,0":
+        ttl = GEOCODE_CACHE_FAILED_TTL
+    else:
+        ttl = GEOCODE_CACHE_TTL
+    remember_geocode(cache_key, lattlong, time.time() + ttl)
+
+    # Too long to be a datastore key, so it only gets cached here
+    if len(cache_key) > GeocodeResult._meta.get_field("address").max_length:
+        return
+
+    try:
+        geocode_result = GeocodeResult.objects.get(address = cache_key)
+    except GeocodeResult.DoesNotExist:
+        geocode_result = GeocodeResult(address = cache_key)
+    geocode_result.latt_long = lattlong
+
+    try:
+        geocode_result.save()
+    except IntegrityError:
+        # Another request has just cached the same address
+        pass
+
+
+def get_remembered_geocode(cache_key):
+
+    with _geocode_cache_lock:
+        cached_geocode = _geocode_cache.pop(cache_key, None)
+        if cached_geocode and cached_geocode[1] > time.time():
+            _geocode_cache[cache_key] = cached_geocode
+            return cached_geocode[0]
+
+    return None
+
+
+def remember_geocode(cache_key, lattlong, expires):
+
+    with _geocode_cache_lock:
+        _geocode_cache.pop(cache_key, None)
+        _geocode_cache[cache_key] = (lattlong, expires)
+        while len(_geocode_cache) > GEOCODE_CACHE_SIZE:
+            _geocode_cache.popitem(last=False)
+
+
+def count_geocode_stat(stat, count = 1):
+
+    memcache.incr(GEOCODE_STATS_MC_KEYS[stat], delta=count, initial_value=0)
+
+
+def get_geocode_stats():
+
+    geocode_stats = memcache.get_multi(GEOCODE_STATS_MC_KEYS.values())
+    return dict((stat, geocode_stats.get(key, 0)) for stat, key in GEOCODE_STATS_MC_KEYS.items())
+
+
+def country_counter(name, country):
+    return "%s_%s" % (name, country)
+
+
+def counter_changes(counts, country, sign = 1):
+    """
+    Changes to counters, by counts, a dict of their names to what they
+    change by, and by the same to each one's count for country, if
+    there is one. With a sign of -1 these are taken away.
+    """
+
+    changes = dict((name, sign * count) for name, count in counts.items())
+    if country:
+        for name, count in counts.items():
+            changes[country_counter(name, country)] = sign * count
+    return changes
+
+
+def change_counters(*changes):
+    """
+    Adds to counters, each of changes being a dict of their names to
+    what they change by. Counters are split over shards, one of which
+    is changed at random, so busy counters aren't held up by every
+    change going to the one entity. They're all changed in the one
+    transaction, so a country's counts keep in step with the totals.
+    """
+
+    from models import CounterShard
+
+    totals = {}
+    for counter_changes in changes:
+        for name, change in counter_changes.items():
+            totals[name] = totals.get(name, 0) + change
+    totals = dict((name, change) for name, change in totals.items() if change)
+    if not totals:
+        return
+
+    with transaction.atomic(xg = True):
+        for name, change in totals.items():
+            shard_id = counter_shard_id(name, random.randint(0, COUNTER_SHARDS - 1))
+            try:
+                shard = CounterShard.objects.get(pk = shard_id)
+            except CounterShard.DoesNotExist:
+                shard = CounterShard(shard_id = shard_id, name = name)
+            shard.count = shard.count + change
+            shard.save()
+
+    # Keep the cached counts in step, where there are any
+    memcache.offset_multi(dict((COUNTER_MC_KEY % (name), change) for name, change in totals.items()))
+
+
+def counter_shard_id(name, shard):
+    return "%s-%s" % (name, shard)
+
+
+def get_shard_count(name):
+    """
+    What the named counter's shards add up to. They're got by key,
+    unlike a query on their name, so none that are new are missed.
+    """
+
+    from models import CounterShard
+
+    shard_ids = [counter_shard_id(name, shard) for shard in range(COUNTER_SHARDS)]
+    return sum(shard.count for shard in CounterShard.objects.filter(pk__in = shard_ids))
+
+
+def get_counts(names):
+    """
+    The named counters, as a dict. Counts are cached, so this is
+    usually one memcache call, otherwise each counter's shards are
+    added up.
+    """
+
+    counts = memcache.get_multi([COUNTER_MC_KEY % (name) for name in names])
+    counts = dict((name, counts.get(COUNTER_MC_KEY % (name))) for name in names)
+
+    for name, count in counts.items():
+        if count is None:
+            count = get_shard_count(name)
+            memcache.add(COUNTER_MC_KEY % (name), count, time = COUNTER_CACHE_TTL)
+            # A change made before the count was cached had nothing to
+            # offset, so if there's been one the cached count is dropped
+            shard_count = get_shard_count(name)
+            if shard_count != count:
+                memcache.delete(COUNTER_MC_KEY % (name))
+                count = shard_count
+            counts[name] = count
+
+    return counts
+
+
+def reconcile_counter(name, count, shard_count):
+    """
+    Corrects the named counter to count, which was counted from when
+    its shards added up to shard_count. If they've changed since, it
+    may have been counted part way through a change, so it's left for
+    next time. Otherwise it's changed by the difference, so changes
+    made after are kept.
+    """
+
+    if get_shard_count(name) != shard_count:
+        logging.warning("Counter %s changed while it was counted" % (name))
+        return False
+
+    drift = count - shard_count
+    if drift:
+        logging.warning("Counter %s was out by %s" % (name, -drift))
+        change_counters({name:drift})
+    memcache.delete(COUNTER_MC_KEY % (name))
+    return True
+
+
+# Order totals rolled up from the food banks, with the snapshot they
+# came from
+_order_totals = (None, None)
+
+
+def get_order_totals():
+    """
+    Totals of every food bank's orders, overall and for each country,
+    added up from the totals kept on each food bank.
+    """
+
+    global _order_totals
+
+    foodbanks = get_all_foodbanks()
+
+    cached_foodbanks, order_totals = _order_totals
+    if cached_foodbanks is foodbanks:
+        return order_totals
+
+    def empty_totals():
+        return {
+            "orders":0,
+            "weight":0,
+            "calories":0,
+            "cost":0,
+            "items":0,
+            "active_foodbanks":0,
+        }
+
+    order_totals = {
+        "total":empty_totals(),
+        "countries":{},
+    }
+    for foodbank in foodbanks:
+        if not foodbank.order_count:
+            continue
+        for totals in [order_totals["total"], order_totals["countries"].setdefault(foodbank.country, empty_totals())]:
+            totals["orders"] = totals["orders"] + foodbank.order_count
+            totals["weight"] = totals["weight"] + foodbank.order_weight
+            totals["calories"] = totals["calories"] + foodbank.order_calories
+            totals["cost"] = totals["cost"] + foodbank.order_cost
+            totals["items"] = totals["items"] + foodbank.order_items
+            totals["active_foodbanks"] = totals["active_foodbanks"] + 1
+
+    _order_totals = (foodbanks, order_totals)
+    return order_totals
+
+
 def parse_tesco_order_text(order_text):
 
     # 10	Tesco Sliced Carrots In Water 300G	£0.30	£3.00
 
     order_lines = []
+    item_catalogue = get_item_catalogue()
 
     order_items = order_text.splitlines()
     for order_item_line in order_items:
         order_item_line_bits = re.split(r'\t+', order_item_line)
 
+        weight = get_weight(order_item_line_bits[1])
         order_lines.append({
             "quantity":int(order_item_line_bits[0]),
             "name":order_item_line_bits[1],
             "item_cost":int(float(order_item_line_bits[2].replace(u"\xA3","").replace(".",""))),
-            "weight":get_weight(order_item_line_bits[1]),
+            "weight":weight,
             "calories":get_calories(
                 order_item_line_bits[1],
-                get_weight(order_item_line_bits[1]),
-                int(order_item_line_bits[0])
+                weight,
+                int(order_item_line_bits[0]),
+                item_catalogue,
             ),
         })
 
@@ -137,6 +810,7 @@ def parse_sainsburys_order_text(order_text):
     # 25 x Hubbard's Foodstore Strawberry Jam 454g - Total Price £7.00
 
     order_lines = []
+    item_catalogue = get_item_catalogue()
 
     order_items = order_text.splitlines()
     for order_item_line in order_items:
@@ -145,30 +819,26 @@ def parse_sainsburys_order_text(order_text):
         logging.info(order_item_line)
         logging.info("Got bits %s, %s, %s" % (order_item_line_bits[0], order_item_line_bits[1], order_item_line_bits[2]))
 
+        weight = get_weight(order_item_line_bits[2])
         order_lines.append({
             "quantity":int(order_item_line_bits[0]),
             "name":order_item_line_bits[2],
             "item_cost":int(float(order_item_line_bits[4].replace(u"\xA3","").replace(".",""))),
-            "weight":get_weight(order_item_line_bits[2]),
+            "weight":weight,
             "calories":get_calories(
                 order_item_line_bits[2],
-                get_weight(order_item_line_bits[2]),
-                int(order_item_line_bits[0])
+                weight,
+                int(order_item_line_bits[0]),
+                item_catalogue,
             ),
         })
 
     return order_lines
 
 
-def get_calories(text, weight, quantity):
+def get_calories(text, weight, quantity, item_catalogue):
 
-    from givefood.models import OrderItem
-
-    try:
-        order_item = OrderItem.objects.get(name = text)
-        calories = order_item.calories
-    except OrderItem.DoesNotExist:
-        calories = 0
+    calories = item_catalogue.calories(text)
 
     total_calories = calories * (weight/100) * quantity
     # logging.info("calories: %s, weight: %s, total: %s" % (calories,weight,total_calories))
@@ -176,145 +846,145 @@ def get_calories(text, weight, quantity):
 
 
 def get_weight(text):
+    """
+    Weight of an item in grams (or ml), from the size at the end of its
+    name. Multipacks are counted in full, and items sold by the pack
+    come from the tables in const.item_weights. 0 if it can't be told.
+    """
+
+    weight = _weights.get(text)
+    if weight is None:
+        weight = parse_weight(text)
+        if len(_weights) >= WEIGHT_CACHE_SIZE:
+            _weights.clear()
+        _weights[text] = weight
+
+    return weight
+
+
+# Weights worked out on this instance, keyed by item name
+_weights = {}
+
+# [count x] size unit, ending the name, perhaps with a note in brackets
+# such as "300g (180g*)" for drained weights
+SIZE_RE = re.compile(r"""
+    (?<![\d.])
+    (?:(?P<count>\d+)\s*x\s*)?
+    (?P<size>\d+(?:\.\d+)?)\s*
+    (?P<unit>%s)
+    (?:\s*\([^)]*\))?
+    $""" % ("|".join(sorted(UNIT_WEIGHTS, key=len, reverse=True))), re.I | re.X)
+
 
-    weight = 0
+def parse_weight(text):
 
-    # 4x400g
-    if text[-7:] == " 4x400g":
-      weight = 1600
+    text = text.strip()
 
-    # 3X250ml
-    if text[-8:] == " 3X250ml":
-      weight = 750
+    if text in ITEM_WEIGHTS:
+        return ITEM_WEIGHTS[text]
 
-    # 4X125g
-    if text[-7:] == " 4X125g":
-      weight = 500
+    for pack, weight in PACK_WEIGHTS.items():
+        if text.endswith(pack):
+            return weight
 
-    # 2X110g
-    if text[-7:] == " 2X110g":
-      weight = 220
+    size = SIZE_RE.search(text)
+    if not size:
+        return 0
 
-    # 2X95g
-    if text[-6:] == " 2X95g":
-      weight = 190
+    weight = float(size.group("size")) * UNIT_WEIGHTS[size.group("unit").lower()]
+    if size.group("count"):
+        weight = weight * int(size.group("count"))
+    return weight
 
-    #2x82g
-    if text[-6:] == " 2x82g":
-      weight = 164
 
-    # 2x95g
-    if text[-6:] == " 2x95g":
-      weight = 190
+def get_all_items():
 
-    #20x27g
-    if text[-7:] == " 20x27g":
-      weight = 540
+    from models import OrderItem
 
-    #4x22g
-    if text[-6:] == " 4x22g":
-        weight = 88
+    return get_snapshot(ITEMS_MC_KEY, ITEMS_GEN_MC_KEY, OrderItem)
 
-    #6x25g
-    if text[-6:] == " 6x25g":
-        weight = 150
 
-    #24x25g
-    if text[-7:] == " 24x25g":
-        weight = 600
+# The item catalogue, with the item snapshot it was built from
+_item_catalogue = (None, None)
 
-    # Kilogram
-    if text[-2:] == "Kg":
-        weight = float(text[-4:].replace("Kg","")) * 1000
 
-    # Kilogram
-    if text[-2:] == "kg":
-        weight = float(text[-4:].replace("kg","")) * 1000
+def get_item_catalogue():
 
-    # Grams
-    if text[-1:] == "G":
-      weight = float(text[-4:].replace("G",""))
+    global _item_catalogue
 
-    # Grams
-    if text[-1:] == "g" and not weight:
-      weight = float(text[-4:].replace("g",""))
+    items = get_all_items()
 
-    # 6x1L
-    if text[-5:] == " 6x1L":
-      weight = 6000
+    cached_items, item_catalogue = _item_catalogue
+    if cached_items is items:
+        return item_catalogue
 
-    # 6x1l
-    if text[-5:] == " 6X1l":
-      weight = 6000
+    logging.info("Building item catalogue")
 
-    # Litre
-    if text[-6:] == " Litre":
-      weight = float(text[-7:].replace(" Litre","")) * 1000
+    item_catalogue = ItemCatalogue(items)
+    _item_catalogue = (items, item_catalogue)
+    return item_catalogue
 
-    # L (Litre)
-    if text[-1:] == "L" and not weight:
-      weight = float(text[-3:].replace("L","")) * 1000
 
-    # Millilitres
-    if text[-2:] == "Ml":
-      weight = float(text[-5:].replace("Ml",""))
+class ItemCatalogue(object):
+    """
+    Order items by name. Names are matched exactly where they can be,
+    otherwise by their normalised form, so the same item written with
+    different case, spacing or punctuation is still found.
+    """
 
-    # Millilitres
-    if text[-2:] == "ml":
-      weight = float(text[-5:].replace("ml",""))
+    def __init__(self, items):
 
-    # Banana 5-pack
-    if text[-6:] == "5 Pack":
-      weight = 750
+        self.by_name = {}
+        self.by_normalised_name = {}
+        for item in items:
+            self.by_name[item.name] = item
+            self.by_normalised_name.setdefault(normalise_item_name(item.name), item)
 
-    # 4 X 410G
-    if text[-9:] == " 4 X 410G":
-      weight = 1640
+    def get(self, name):
 
-    if text[-12:] == " 6 X 1 Litre":
-        weight = 6000
+        item = self.by_name.get(name)
+        if item is None:
+            item = self.by_normalised_name.get(normalise_item_name(name))
+        return item
 
-    if text[-13:] == " 300g (180g*)":
-        weight = 300
+    def calories(self, name):
 
-    ## PIES
-    if text == "Tesco Mince Pies 6 Pack":
-      weight = 324
-    if text == "Tesco Lattice Mince Pies 6 Pack":
-      weight = 324
+        item = self.get(name)
+        if item is None:
+            return 0
+        return item.calories
 
-    return weight
+    def image_id(self, name, delivery_provider):
 
+        item = self.get(name)
+        if item is None:
+            return None
+        if delivery_provider == "Sainsbury's":
+            return item.sainsburys_image_id
+        if delivery_provider == "Tesco":
+            return item.tesco_image_id
+        return None
 
-def get_all_items():
 
-    from models import OrderItem
+def normalise_item_name(name):
 
-    all_items = memcache.get(ITEMS_MC_KEY)
-    if all_items is None:
-        all_items = OrderItem.objects.all()
-        memcache.add(ITEMS_MC_KEY, all_items, 3600)
-    return all_items
+    return " ".join(re.sub(r"[^a-z0-9 ]", "", name.lower()).split())
 
 
 def get_image(delivery_provider, text):
 
-    item_id = ""
     url = None
 
     if not delivery_provider:
         delivery_provider = "Tesco"
 
-    all_items = get_all_items()
+    image_id = get_item_catalogue().image_id(text, delivery_provider)
 
-    for item in all_items:
-        if item.name == text:
-            if delivery_provider == "Sainsbury's":
-                if item.sainsburys_image_id:
-                    url = "https://assets.sainsburys-groceries.co.uk/gol/%s/image.jpg" % (item.sainsburys_image_id)
-            if delivery_provider == "Tesco":
-                if item.tesco_image_id:
-                    url = "https://digitalcontent.api.tesco.com/v1/media/ghs/snapshotimagehandler_%s.jpeg?w=100" % (item.tesco_image_id)
+    if image_id:
+        if delivery_provider == "Sainsbury's":
+            url = "https://assets.sainsburys-groceries.co.uk/gol/%s/image.jpg" % (image_id)
+        if delivery_provider == "Tesco":
+            url = "https://digitalcontent.api.tesco.com/v1/media/ghs/snapshotimagehandler_%s.jpeg?w=100" % (image_id)
 
     if url:
         return url
@@ -324,10 +994,15 @@ def get_image(delivery_provider, text):
 
 def item_class_count(all_items, item_class_items):
 
+    # Matched on normalised names, as the class lists and order lines
+    # don't always agree on case and punctuation
+    class_names = set(normalise_item_name(class_item) for class_item in item_class_items)
+
     count = 0
 
-    for class_item in item_class_items:
-        count = count + all_items.get(class_item, 0)
+    for name, quantity in all_items.items():
+        if normalise_item_name(name) in class_names:
+            count = count + quantity
 
     return count
 
@@ -403,97 +1078,351 @@ def is_uk(lat_lng):
 
 def find_foodbanks(lattlong, quantity = 10, skip_first = False):
 
-    foodbanks = get_all_open_foodbanks()
-
     latt = float(lattlong.split(",")[0])
     long = float(lattlong.split(",")[1])
 
-    for foodbank in foodbanks:
-        foodbank.distance_m = distance_meters(foodbank.latt(), foodbank.long(), latt, long)
-        foodbank.distance_mi = miles(foodbank.distance_m)
+    foodbank_index = get_search_index("foodbanks")
 
-    sorted_foodbanks = sorted(foodbanks, key=operator.attrgetter('distance_m'))
+    foodbanks = []
+    for distance_m, foodbank in foodbank_index.nearest(latt, long, quantity, skip_first):
+        foodbanks.append(SearchResult(foodbank, distance_m))
 
-    if skip_first:
-        first_item = 1
-        quantity = quantity + 1
-    else:
-        first_item = 0
+    return foodbanks
 
-    return sorted_foodbanks[first_item:quantity]
 
+def find_foodbanks_many(lattlongs, quantity = 10):
+    """
+    find_foodbanks for each of lattlongs, all from the one search index.
+    """
 
-def find_locations(lattlong, quantity = 10, skip_first = False):
+    foodbank_index = get_search_index("foodbanks")
+
+    results = []
+    for lattlong in lattlongs:
+        latt = float(lattlong.split(",")[0])
+        long = float(lattlong.split(",")[1])
+        results.append([SearchResult(foodbank, distance_m) for distance_m, foodbank in foodbank_index.nearest(latt, long, quantity, False)])
+
+    return results
 
-    locations = get_all_locations()
-    foodbanks = get_all_open_foodbanks()
+
+def find_locations(lattlong, quantity = 10, skip_first = False):
 
     latt = float(lattlong.split(",")[0])
     long = float(lattlong.split(",")[1])
 
+    location_index = get_search_index("locations")
+
     searchable_locations = []
+    for distance_m, place in location_index.nearest(latt, long, quantity, skip_first):
+        searchable_locations.append(PlaceSearchResult(place, distance_m))
 
-    for location in locations:
-        searchable_locations.append({
-            "type":"location",
-            "name":location.name,
-            "lat":location.latt(),
-            "lng":location.long(),
-            "lat_lng":location.latt_long,
-            "address":location.full_address(),
-            "postcode":location.postcode,
-            "parliamentary_constituency":location.parliamentary_constituency,
-            "parliamentary_constituency_slug":location.parliamentary_constituency_slug,
-            "mp":location.mp,
-            "mp_party":location.mp_party,
-            "mp_parl_id":location.mp_parl_id,
-            "ward":location.ward,
-            "district":location.district,
-            "phone":location.phone_or_foodbank_phone(),
-            "email":location.email_or_foodbank_email(),
-            "slug":location.slug,
-            "foodbank_slug":location.foodbank_slug,
-            "foodbank_name":location.foodbank_name,
-            "foodbank_network":location.foodbank_network,
-        })
+    return searchable_locations
 
-    for foodbank in foodbanks:
-        searchable_locations.append({
-            "type":"organisation",
-            "name":foodbank.name,
-            "lat":foodbank.latt(),
-            "lng":foodbank.long(),
-            "lat_lng":foodbank.latt_long,
-            "address":foodbank.full_address(),
-            "postcode":foodbank.postcode,
-            "parliamentary_constituency":foodbank.parliamentary_constituency,
-            "parliamentary_constituency_slug":foodbank.parliamentary_constituency_slug,
-            "mp":foodbank.mp,
-            "mp_party":foodbank.mp_party,
-            "mp_parl_id":foodbank.mp_parl_id,
-            "ward":foodbank.ward,
-            "district":foodbank.district,
-            "phone":foodbank.phone_number,
-            "email":foodbank.contact_email,
-            "slug":foodbank.slug,
-            "foodbank_slug":foodbank.slug,
-            "foodbank_name":foodbank.name,
-            "foodbank_network":foodbank.network,
-        })
 
-    for searchable_location in searchable_locations:
-        searchable_location["distance_m"] = distance_meters(searchable_location.get("lat"), searchable_location.get("lng"), latt, long)
-        searchable_location["distance_mi"] = miles(searchable_location.get("distance_m"))
+class SearchablePlace(object):
+    """
+    A row of the searchable places table - a location or food bank with
+    everything a location search gives back already worked out. The
+    table is built along with the search index and shared by every
+    search on the instance.
+    """
+
+    __slots__ = (
+        "type",
+        "name",
+        "lat",
+        "lng",
+        "lat_lng",
+        "address",
+        "postcode",
+        "parliamentary_constituency",
+        "parliamentary_constituency_slug",
+        "mp",
+        "mp_party",
+        "mp_parl_id",
+        "ward",
+        "district",
+        "phone",
+        "email",
+        "slug",
+        "foodbank_slug",
+        "foodbank_name",
+        "foodbank_network",
+    )
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+
+def searchable_location(location):
+
+    return SearchablePlace(
+        type = "location",
+        name = location.name,
+        lat = location.latt(),
+        lng = location.long(),
+        lat_lng = location.latt_long,
+        address = location.full_address(),
+        postcode = location.postcode,
+        parliamentary_constituency = location.parliamentary_constituency,
+        parliamentary_constituency_slug = location.parliamentary_constituency_slug,
+        mp = location.mp,
+        mp_party = location.mp_party,
+        mp_parl_id = location.mp_parl_id,
+        ward = location.ward,
+        district = location.district,
+        phone = location.phone_or_foodbank_phone(),
+        email = location.email_or_foodbank_email(),
+        slug = location.slug,
+        foodbank_slug = location.foodbank_slug,
+        foodbank_name = location.foodbank_name,
+        foodbank_network = location.foodbank_network,
+    )
+
+
+def searchable_foodbank(foodbank):
+
+    return SearchablePlace(
+        type = "organisation",
+        name = foodbank.name,
+        lat = foodbank.latt(),
+        lng = foodbank.long(),
+        lat_lng = foodbank.latt_long,
+        address = foodbank.full_address(),
+        postcode = foodbank.postcode,
+        parliamentary_constituency = foodbank.parliamentary_constituency,
+        parliamentary_constituency_slug = foodbank.parliamentary_constituency_slug,
+        mp = foodbank.mp,
+        mp_party = foodbank.mp_party,
+        mp_parl_id = foodbank.mp_parl_id,
+        ward = foodbank.ward,
+        district = foodbank.district,
+        phone = foodbank.phone_number,
+        email = foodbank.contact_email,
+        slug = foodbank.slug,
+        foodbank_slug = foodbank.slug,
+        foodbank_name = foodbank.name,
+        foodbank_network = foodbank.network,
+    )
+
+
+class SearchResult(object):
+    """
+    A search result for one request. The found item comes from a search
+    index that every request on the instance shares, so it is never
+    written to - anything else asked of the result is read from it.
+    """
 
-    sorted_searchable_locations = sorted(searchable_locations, key=lambda k: k['distance_m'])
+    __slots__ = ("item", "distance_m", "distance_mi")
 
-    if skip_first:
-        first_item = 1
-        quantity = quantity + 1
+    def __init__(self, item, distance_m):
+        self.item = item
+        self.distance_m = distance_m
+        self.distance_mi = miles(distance_m)
+
+    def __getattr__(self, name):
+        if name in SearchResult.__slots__:
+            raise AttributeError(name)
+        return getattr(self.item, name)
+
+
+class PlaceSearchResult(SearchResult):
+    """
+    A location search result. Location results have always been dicts,
+    so these can be read like one too.
+    """
+
+    __slots__ = ("needs",)
+
+    def __init__(self, item, distance_m):
+        super(PlaceSearchResult, self).__init__(item, distance_m)
+        self.needs = None
+
+    def get(self, name, default = None):
+        return getattr(self, name, default)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+
+# Spatial indexes built on this instance, keyed by name.
+# Each is stored with the snapshots it was built from, which may be
+# older than the current generation while they're being rebuilt.
+_search_indexes = {}
+
+
+def get_search_index(index_name):
+
+    foodbanks = get_all_foodbanks()
+    locations = get_all_locations()
+
+    cached_index = _search_indexes.get(index_name)
+    if cached_index and cached_index[0] is foodbanks and cached_index[1] is locations:
+        return cached_index[2]
+
+    logging.info("Building %s search index" % (index_name))
+
+    open_foodbanks = [foodbank for foodbank in foodbanks if not foodbank.is_closed]
+    items = []
+    lat_lngs = []
+
+    if index_name == "locations":
+        for location in locations:
+            items.append(searchable_location(location))
+        for foodbank in open_foodbanks:
+            items.append(searchable_foodbank(foodbank))
+        for place in items:
+            lat_lngs.append((place.lat, place.lng))
     else:
-        first_item = 0
+        for foodbank in open_foodbanks:
+            items.append(foodbank)
+            lat_lngs.append((foodbank.latt(), foodbank.long()))
+
+    search_index = SpatialIndex(items, lat_lngs)
+    _search_indexes[index_name] = (foodbanks, locations, search_index)
+    return search_index
+
+
+class SpatialIndex(object):
+    """
+    A k-d tree of places for nearest neighbour searches.
+
+    Places are stored as points on a unit sphere, so the tree can split
+    on plain x, y and z co-ordinates. The gap between a point and a
+    splitting plane is never more than the great circle distance between
+    them, which lets whole branches be skipped once we have enough
+    closer places. Places in the leaves are measured with the
+    DistanceEngine.
+    """
+
+    LEAF_SIZE = 8
+
+    def __init__(self, items, lat_lngs):
+
+        self.items = tuple(items)
+        self.engine = DistanceEngine(lat_lngs)
+        self.points = []
+        for latt, long in lat_lngs:
+            self.points.append(unit_vector(latt, long))
+
+        self.root = self._build(range(len(items)))
+
+    def _build(self, indexes):
+
+        if len(indexes) <= self.LEAF_SIZE:
+            return indexes
+
+        # Split on the axis with the widest spread of points
+        spreads = []
+        for axis in range(3):
+            values = [self.points[index][axis] for index in indexes]
+            spreads.append(max(values) - min(values))
+        axis = spreads.index(max(spreads))
+
+        indexes = sorted(indexes, key=lambda index: self.points[index][axis])
+        median = len(indexes) // 2
+        split = self.points[indexes[median]][axis]
+
+        return (axis, split, self._build(indexes[:median]), self._build(indexes[median:]))
+
+    def nearest(self, latt, long, quantity = 10, skip_first = False):
+        """
+        Returns (distance in meters, item) pairs for the nearest items,
+        closest first. With skip_first the very closest is left out,
+        for when the search is centred on one of the indexed places.
+        """
+
+        if skip_first:
+            first_item = 1
+            quantity = quantity + 1
+        else:
+            first_item = 0
+
+        if quantity <= 0:
+            return []
+
+        # Max heap of the closest found so far, as negated (distance, index)
+        closest = []
+        self._search(self.root, unit_vector(latt, long), self.engine.query(latt, long), quantity, closest)
+        nearest = sorted((-distance, -index) for distance, index in closest)
+
+        return [(distance, self.items[index]) for distance, index in nearest[first_item:]]
+
+    def _search(self, node, point, query, quantity, closest):
+
+        if isinstance(node, list):
+            for index, distance in zip(node, self.engine.distances(query, node)):
+                if len(closest) < quantity:
+                    heapq.heappush(closest, (-distance, -index))
+                elif (-distance, -index) > closest[0]:
+                    heapq.heapreplace(closest, (-distance, -index))
+            return
+
+        axis, split, below, above = node
+        gap = point[axis] - split
+        if gap < 0:
+            near, far = below, above
+        else:
+            near, far = above, below
+
+        self._search(near, point, query, quantity, closest)
+
+        if len(closest) < quantity or abs(gap) * EARTH_RADIUS_M <= -closest[0][0]:
+            self._search(far, point, query, quantity, closest)
+
+
+class DistanceEngine(object):
+    """
+    Haversine distances from a point to a fixed set of places.
+
+    Co-ordinates are packed into float arrays already in radians, along
+    with the cosine of each latitude, so none of that is redone per
+    search. The answers are exactly those of distance_meters.
+    """
+
+    def __init__(self, lat_lngs):
+
+        self.lat_radians = array("d", [radians(latt) for latt, long in lat_lngs])
+        self.long_radians = array("d", [radians(long) for latt, long in lat_lngs])
+        self.cos_lats = array("d", [cos(latt) for latt in self.lat_radians])
+
+    def __len__(self):
+        return len(self.lat_radians)
+
+    def query(self, latt, long):
 
-    return sorted_searchable_locations[first_item:quantity]
+        latt = radians(latt)
+        return (latt, radians(long), cos(latt))
+
+    def distances(self, query, indexes):
+        """
+        Distances in meters from the query to each of the given places.
+        """
+
+        latt, long, cos_latt = query
+        lat_radians, long_radians, cos_lats = self.lat_radians, self.long_radians, self.cos_lats
+
+        distances = []
+        for index in indexes:
+            dlon = long - long_radians[index]
+            dlat = latt - lat_radians[index]
+            a = sin(dlat/2)**2 + cos_lats[index] * cos_latt * sin(dlon/2)**2
+            distances.append(EARTH_RADIUS_M * (2 * asin(sqrt(a))))
+        return distances
+
+
+def unit_vector(latt, long):
+
+    latt, long = radians(latt), radians(long)
+    return (cos(latt) * cos(long), cos(latt) * sin(long), sin(latt))
+
+
+EARTH_RADIUS_M = 6367000
 
 
 def miles(meters):
@@ -512,7 +1441,7 @@ def distance_meters(lat1, lon1, lat2, lon2):
     dlat = lat2 - lat1
     a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
     c = 2 * asin(sqrt(a))
-    meters = 6367000 * c
+    meters = EARTH_RADIUS_M * c
     return meters
 
 
@@ -556,7 +1485,563 @@ def mpid_from_name(name):
 
 
 def lattlong_from_postcode(postcode):
-    pass
+    """
+    "lat,lng" for a UK postcode or outcode from the bundled postcode
+    data, without going to the network. None if the query isn't shaped
+    like a postcode or isn't known, so callers can fall back to geocode().
+    """
+
+    postcode = "".join(postcode.upper().split())
+    if not POSTCODE_REGEX.match(postcode) and not OUTCODE_REGEX.match(postcode):
+        return None
+
+    lat_lng = get_postcode_index().lat_lng(postcode)
+    if lat_lng:
+        return "%s,%s" % lat_lng
+    return None
+
+
+POSTCODE_REGEX = re.compile(r"^[A-Z]{1,2}[0-9][0-9A-Z]?[0-9][A-Z]{2}$")
+OUTCODE_REGEX = re.compile(r"^[A-Z]{1,2}[0-9][0-9A-Z]?$")
+
+_postcode_index = None
+_postcode_index_lock = threading.Lock()
+
+
+def get_postcode_index():
+
+    global _postcode_index
+
+    if _postcode_index is None:
+        with _postcode_index_lock:
+            if _postcode_index is None:
+                _postcode_index = PostcodeIndex.load(POSTCODES_DATA_DIR)
+    return _postcode_index
+
+
+class PostcodeIndex(object):
+    """
+    Postcode and outcode centroids, in the packed files made from the ONS
+    Postcode Directory by the build_postcodes command.
+    """
+
+    POSTCODE_WIDTH = 7
+    OUTCODE_WIDTH = 4
+
+    def __init__(self, postcodes, outcodes):
+
+        self.postcodes = postcodes
+        self.outcodes = outcodes
+
+    def __len__(self):
+        return len(self.postcodes)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load the packed files from directory. Missing or broken files give
+        an empty index, which is logged as an error as every postcode
+        search will then go to geocode().
+        """
+
+        try:
+            postcodes = PackedCoordinates.load(directory, "postcodes", cls.POSTCODE_WIDTH)
+            outcodes = PackedCoordinates.load(directory, "outcodes", cls.OUTCODE_WIDTH)
+        except (IOError, ValueError) as e:
+            logging.error("No postcode data in %s: %s" % (directory, e))
+            postcodes = PackedCoordinates(cls.POSTCODE_WIDTH)
+            outcodes = PackedCoordinates(cls.OUTCODE_WIDTH)
+
+        return cls(postcodes, outcodes)
+
+    def save(self, directory):
+
+        self.postcodes.save(directory, "postcodes")
+        self.outcodes.save(directory, "outcodes")
+
+    @classmethod
+    def from_csv(cls, csvfile):
+        """
+        Build an index from an ONS Postcode Directory style CSV. The
+        postcode column can be pcds, pcd or postcode, and the coordinates
+        lat/long or latitude/longitude. Terminated postcodes and those
+        without a location are skipped. Outcodes are the mean of their
+        postcodes.
+
+        This reads the whole directory into memory, so is only for
+        building the packed files, never for serving.
+        """
+
+        reader = csv.reader(csvfile)
+        header = [column.strip().lower() for column in next(reader, [])]
+
+        postcode_col = cls.column(header, "pcds", "pcd", "postcode")
+        lat_col = cls.column(header, "lat", "latitude")
+        lng_col = cls.column(header, "long", "longitude", "lng")
+        term_col = cls.column(header, "doterm")
+
+        if None in (postcode_col, lat_col, lng_col):
+            raise ValueError("No postcode, lat and long columns")
+
+        postcodes = []
+        outcode_totals = {}
+
+        for row in reader:
+            if term_col is not None and row[term_col].strip():
+                continue
+            try:
+                lat = float(row[lat_col])
+                lng = float(row[lng_col])
+            except (ValueError, IndexError):
+                continue
+            # ONSPD marks postcodes with no grid reference as 99.999999
+            if lat > 90:
+                continue
+            postcode = "".join(row[postcode_col].upper().split())
+            if not POSTCODE_REGEX.match(postcode):
+                continue
+
+            postcodes.append((postcode, lat, lng))
+            totals = outcode_totals.setdefault(postcode[:-3], [0.0, 0.0, 0])
+            totals[0] += lat
+            totals[1] += lng
+            totals[2] += 1
+
+        outcodes = [(outcode, lat / count, lng / count) for outcode, (lat, lng, count) in outcode_totals.items()]
+
+        return cls(
+            PackedCoordinates.from_list(postcodes, cls.POSTCODE_WIDTH),
+            PackedCoordinates.from_list(outcodes, cls.OUTCODE_WIDTH),
+        )
+
+    @staticmethod
+    def column(header, *names):
+
+        for name in names:
+            if name in header:
+                return header.index(name)
+        return None
+
+    def lat_lng(self, postcode):
+
+        if len(postcode) < 5:
+            return self.outcodes.get(postcode)
+
+        # Newer than our data, so use the middle of its outcode
+        return self.postcodes.get(postcode) or self.outcodes.get(postcode[:-3])
+
+
+class PackedCoordinates(object):
+    """
+    Coordinates looked up by a short string key. Keys are padded to a
+    fixed width and joined into one sorted string, with the coordinates
+    in parallel float arrays, so a couple of million take a few tens of
+    megabytes and are found by binary search.
+
+    On disk they're three files, name.keys with the joined keys and
+    name.lats and name.lngs with little endian 32 bit floats, which load
+    straight into the arrays.
+    """
+
+    def __init__(self, width, keys = "", lats = None, lngs = None):
+
+        self.width = width
+        self.keys = keys
+        self.lats = lats if lats is not None else array("f")
+        self.lngs = lngs if lngs is not None else array("f")
+
+    def __len__(self):
+        return len(self.lats)
+
+    @classmethod
+    def from_list(cls, coordinates, width):
+        """
+        From a list of (key, lat, lng).
+        """
+
+        coordinates = sorted(coordinates)
+        return cls(
+            width,
+            "".join(key.ljust(width) for key, lat, lng in coordinates),
+            array("f", [lat for key, lat, lng in coordinates]),
+            array("f", [lng for key, lat, lng in coordinates]),
+        )
+
+    @classmethod
+    def load(cls, directory, name, width):
+
+        path = os.path.join(directory, name)
+
+        with open("%s.keys" % (path), "rb") as keys_file:
+            keys = keys_file.read()
+        count = len(keys) // width
+
+        lats = cls.load_floats("%s.lats" % (path), count)
+        lngs = cls.load_floats("%s.lngs" % (path), count)
+
+        if len(keys) != count * width:
+            raise ValueError("%s.keys isn't a whole number of keys" % (path))
+
+        return cls(width, keys, lats, lngs)
+
+    @staticmethod
+    def load_floats(filename, count):
+
+        floats = array("f")
+        with open(filename, "rb") as floats_file:
+            try:
+                floats.fromfile(floats_file, count)
+            except EOFError:
+                raise ValueError("%s is shorter than its keys" % (filename))
+        if sys.byteorder != "little":
+            floats.byteswap()
+        return floats
+
+    def save(self, directory, name):
+
+        path = os.path.join(directory, name)
+
+        with open("%s.keys" % (path), "wb") as keys_file:
+            keys_file.write(self.keys)
+        for extension, floats in (("lats", self.lats), ("lngs", self.lngs)):
+            floats = array("f", floats)
+            if sys.byteorder != "little":
+                floats.byteswap()
+            with open("%s.%s" % (path, extension), "wb") as floats_file:
+                floats.tofile(floats_file)
+
+    def get(self, key):
+        """
+        (lat, lng) for the key, or None.
+        """
+
+        width = self.width
+        key = key.ljust(width)
+        lo = 0
+        hi = len(self.lats)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.keys[mid * width:(mid + 1) * width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.lats) and self.keys[lo * width:(lo + 1) * width] == key:
+            return (round(self.lats[lo], 6), round(self.lngs[lo], 6))
+        return None
+
+
+def constituency_from_lattlong(lattlong):
+    """
+    The parliamentary constituency containing a "lat,lng", found in
+    memory from the bundled boundaries. None if it's outside them all,
+    which can happen right on the coast.
+    """
+
+    try:
+        latt, lng = [float(coord) for coord in lattlong.split(",")]
+    except (AttributeError, ValueError):
+        return None
+
+    return get_constituency_index().constituency(latt, lng)
+
+
+_constituency_index = None
+_constituency_index_lock = threading.Lock()
+
+
+def get_constituency_index():
+
+    global _constituency_index
+
+    if _constituency_index is None:
+        with _constituency_index_lock:
+            if _constituency_index is None:
+                _constituency_index = ConstituencyIndex.from_geojson(PARLCON_BOUNDARIES_FILE)
+    return _constituency_index
+
+
+class ConstituencyIndex(object):
+    """
+    Constituency boundaries in a packed R-tree of bounding boxes. Each
+    polygon of each constituency is a leaf entry holding its rings as
+    flat coordinate arrays, and a point is tested against only the
+    polygons whose boxes hold it.
+    """
+
+    NODE_SIZE = 8
+
+    def __init__(self, polygons):
+
+        # polygons are (name, rings) with rings as lists of [lng, lat]
+        entries = []
+        for name, rings in polygons:
+            packed_rings = []
+            for ring in rings:
+                lngs = array("d", [point[0] for point in ring])
+                lats = array("d", [point[1] for point in ring])
+                packed_rings.append((lngs, lats))
+            outer_lngs, outer_lats = packed_rings[0]
+            bbox = (min(outer_lngs), min(outer_lats), max(outer_lngs), max(outer_lats))
+            entries.append((bbox, name, packed_rings))
+
+        self.size = len(entries)
+        self.root = self.build(entries, True)
+
+    @classmethod
+    def from_geojson(cls, filename):
+
+        with open(filename, "r") as geojson_file:
+            geojson = json.load(geojson_file)
+
+        # Northern Ireland's boundaries come from elsewhere, with their
+        # names in capitals, so take the casing from our list of MPs
+        names = dict((name.decode("utf8").lower(), name.decode("utf8")) for name in parlcon_mp)
+
+        polygons = []
+        for feature in geojson["features"]:
+            properties = feature["properties"]
+            name = properties.get("pcon16nm") or properties.get("PC_NAME")
+            name = names.get(name.lower(), name)
+            geometry = feature["geometry"]
+            if geometry["type"] == "Polygon":
+                polygons.append((name, geometry["coordinates"]))
+            elif geometry["type"] == "MultiPolygon":
+                for polygon in geometry["coordinates"]:
+                    polygons.append((name, polygon))
+
+        return cls(polygons)
+
+    def build(self, entries, leaf):
+        """
+        Sort-tile-recursive packing: slice the entries into vertical
+        strips by box centre, group each strip top to bottom into nodes,
+        and repeat one level up until a single root is left.
+        """
+
+        if not entries:
+            return ((0, 0, 0, 0), (), True)
+
+        nodes = []
+        node_count = -(-len(entries) // self.NODE_SIZE)
+        strip_count = int(sqrt(node_count)) or 1
+        strip_size = -(-len(entries) // strip_count)
+
+        entries = sorted(entries, key=lambda entry: entry[0][0] + entry[0][2])
+        for strip_start in range(0, len(entries), strip_size):
+            strip = sorted(entries[strip_start:strip_start + strip_size], key=lambda entry: entry[0][1] + entry[0][3])
+            for node_start in range(0, len(strip), self.NODE_SIZE):
+                children = tuple(strip[node_start:node_start + self.NODE_SIZE])
+                bbox = (
+                    min(child[0][0] for child in children),
+                    min(child[0][1] for child in children),
+                    max(child[0][2] for child in children),
+                    max(child[0][3] for child in children),
+                )
+                nodes.append((bbox, children, leaf))
+
+        if len(nodes) == 1:
+            return nodes[0]
+        return self.build(nodes, False)
+
+    def constituency(self, latt, lng):
+
+        stack = [self.root]
+        while stack:
+            bbox, children, leaf = stack.pop()
+            for child in children:
+                child_bbox = child[0]
+                if not (child_bbox[0] <= lng <= child_bbox[2] and child_bbox[1] <= latt <= child_bbox[3]):
+                    continue
+                if not leaf:
+                    stack.append(child)
+                elif point_in_rings(lng, latt, child[2]):
+                    return child[1]
+        return None
+
+
+def point_in_rings(x, y, rings):
+    """
+    Even-odd ray casting across all of a polygon's rings, so a point in
+    a hole counts as outside.
+    """
+
+    inside = False
+    for xs, ys in rings:
+        j = len(xs) - 1
+        for i in xrange(len(xs)):
+            yi = ys[i]
+            yj = ys[j]
+            if (yi > y) != (yj > y):
+                if x < (xs[j] - xs[i]) * (y - yi) / (yj - yi) + xs[i]:
+                    inside = not inside
+            j = i
+    return inside
+
+
+def simplify_boundaries(boundary_geojson):
+    """
+    A constituency's boundary feature simplified at each of
+    BOUNDARY_SIMPLIFY_TOLERANCES, as JSON text keyed by level.
+    """
+
+    feature = parse_boundary_geojson(boundary_geojson)
+
+    simplified = {}
+    for level, tolerance in BOUNDARY_SIMPLIFY_TOLERANCES.items():
+        simplified_feature = dict(feature)
+        simplified_feature["geometry"] = simplify_geometry(feature["geometry"], tolerance)
+        simplified[level] = json.dumps(simplified_feature, separators=(",",":"))
+    return json.dumps(simplified, separators=(",",":"))
+
+
+def parse_boundary_geojson(boundary_geojson):
+
+    boundary_geojson = boundary_geojson.strip()
+    # remove last char if a comma
+    if boundary_geojson[-1:] == ",":
+        boundary_geojson = boundary_geojson[:-1]
+    return json.loads(boundary_geojson)
+
+
+# Parsed boundaries, keyed on a digest of the full boundary they came
+# from so a changed boundary is never served stale
+_boundary_cache = OrderedDict()
+_boundary_cache_lock = threading.Lock()
+
+
+def get_boundary_geojson_dict(boundary_geojson, boundary_geojson_simplified=None, simplify=None, precision=None):
+
+    cache_key = (hashlib.md5(boundary_geojson.encode("utf8") if isinstance(boundary_geojson, unicode) else boundary_geojson).hexdigest(), simplify, precision)
+
+    with _boundary_cache_lock:
+        boundary = _boundary_cache.pop(cache_key, None)
+        if boundary is not None:
+            _boundary_cache[cache_key] = boundary
+            return boundary
+
+    if simplify:
+        simplified = json.loads(boundary_geojson_simplified or simplify_boundaries(boundary_geojson))
+        boundary_geojson = simplified[simplify]
+
+    boundary = parse_boundary_geojson(boundary_geojson)
+    if precision is not None:
+        boundary["geometry"] = round_geometry(boundary["geometry"], precision)
+
+    with _boundary_cache_lock:
+        _boundary_cache[cache_key] = boundary
+        while len(_boundary_cache) > BOUNDARY_CACHE_SIZE:
+            _boundary_cache.popitem(last=False)
+
+    return boundary
+
+
+def simplify_geometry(geometry, tolerance):
+    """
+    Douglas-Peucker simplify a GeoJSON Polygon or MultiPolygon. Rings
+    simplified away to nothing are dropped, apart from the outer ring of
+    the largest polygon, which is kept as it was.
+    """
+
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    else:
+        polygons = geometry["coordinates"]
+
+    simplified_polygons = []
+    for polygon in polygons:
+        simplified_polygon = []
+        for ring in polygon:
+            simplified_ring = simplify_line(ring, tolerance)
+            if len(simplified_ring) >= 4:
+                simplified_polygon.append(simplified_ring)
+            elif not simplified_polygon:
+                break
+        if simplified_polygon:
+            simplified_polygons.append(simplified_polygon)
+
+    if not simplified_polygons:
+        simplified_polygons = [[max((polygon[0] for polygon in polygons), key=len)]]
+
+    if len(simplified_polygons) == 1:
+        return {"type":"Polygon", "coordinates":simplified_polygons[0]}
+    return {"type":"MultiPolygon", "coordinates":simplified_polygons}
+
+
+def simplify_line(points, tolerance):
+
+    if len(points) < 3:
+        return list(points)
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+
+    # Closed rings start and end on the same point, so split them at the
+    # point furthest from it
+    first = 0
+    last = len(points) - 1
+    stack = []
+    if points[first] == points[last]:
+        x0, y0 = points[first][0], points[first][1]
+        furthest = max(range(1, last), key=lambda i: (points[i][0] - x0) ** 2 + (points[i][1] - y0) ** 2)
+        keep[furthest] = True
+        stack.append((first, furthest))
+        stack.append((furthest, last))
+    else:
+        stack.append((first, last))
+
+    tolerance_squared = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        x1, y1 = points[first][0], points[first][1]
+        x2, y2 = points[last][0], points[last][1]
+        dx = x2 - x1
+        dy = y2 - y1
+        length_squared = dx * dx + dy * dy
+
+        max_distance = -1
+        max_index = first
+        for i in xrange(first + 1, last):
+            px = points[i][0] - x1
+            py = points[i][1] - y1
+            if length_squared:
+                cross = px * dy - py * dx
+                distance = cross * cross / length_squared
+            else:
+                distance = px * px + py * py
+            if distance > max_distance:
+                max_distance = distance
+                max_index = i
+
+        if max_distance > tolerance_squared:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def round_geometry(geometry, precision):
+    """
+    Round a Polygon or MultiPolygon's coordinates to a number of decimal
+    places, dropping points that then repeat.
+    """
+
+    def round_ring(ring):
+        rounded_ring = []
+        for point in ring:
+            rounded_point = [round(point[0], precision), round(point[1], precision)]
+            if not rounded_ring or rounded_ring[-1] != rounded_point:
+                rounded_ring.append(rounded_point)
+        return rounded_ring
+
+    if geometry["type"] == "Polygon":
+        coordinates = [round_ring(ring) for ring in geometry["coordinates"]]
+    else:
+        coordinates = [[round_ring(ring) for ring in polygon] for polygon in geometry["coordinates"]]
+    return {"type":geometry["type"], "coordinates":coordinates}
 
 
 def make_url_friendly(url):
@@ -565,15 +2050,34 @@ def make_url_friendly(url):
     return url
 
 
+# Every credential's latest value, with when to load them again
+_credentials = None
+
+
 def get_cred(cred_name):
 
+    global _credentials
+
+    if _credentials is None or _credentials[0] < time.time():
+        _credentials = (time.time() + CRED_CACHE_TTL, get_all_creds())
+    return _credentials[1].get(cred_name)
+
+
+def get_all_creds():
+
     from models import GfCredential
 
-    try:
-        credential = GfCredential.objects.filter(cred_name = cred_name).latest("created")
-        return credential.cred_value
-    except GfCredential.DoesNotExist:
-        return None
+    credentials = {}
+    for credential in GfCredential.objects.all().order_by("created"):
+        credentials[credential.cred_name] = credential.cred_value
+    return credentials
+
+
+def clear_cred_cache():
+
+    global _credentials
+
+    _credentials = None
 
 
 def post_to_facebook(need):
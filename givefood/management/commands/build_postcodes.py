@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from givefood.func import PostcodeIndex
+from givefood.const.general import POSTCODES_DATA_DIR
+
+
+class Command(BaseCommand):
+    help = "Packs an ONS Postcode Directory CSV into the postcode files lattlong_from_postcode loads"
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file")
+        parser.add_argument("--output", default=POSTCODES_DATA_DIR)
+
+    def handle(self, *args, **options):
+
+        try:
+            with open(options["csv_file"], "rb") as csvfile:
+                postcode_index = PostcodeIndex.from_csv(csvfile)
+        except (IOError, ValueError) as e:
+            raise CommandError(str(e))
+
+        postcode_index.save(options["output"])
+        self.stdout.write("Packed %s postcodes and %s outcodes into %s" % (len(postcode_index), len(postcode_index.outcodes), options["output"]))
@@ -1,18 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import hashlib, unicodedata, logging, json
+import hashlib, unicodedata, logging, json, calendar
 from datetime import datetime
 
-from google.appengine.api import memcache
 from google.appengine.ext import deferred
 
 from django.db import models
+from djangae.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.template.defaultfilters import slugify
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
-from const.general import DELIVERY_HOURS_CHOICES, COUNTRIES_CHOICES, DELIVERY_PROVIDER_CHOICES, FOODBANK_NETWORK_CHOICES, PACKAGING_WEIGHT_PC, FB_MC_KEY
-from func import parse_tesco_order_text, parse_sainsburys_order_text, clean_foodbank_need_text, admin_regions_from_postcode, mp_from_parlcon, geocode, make_url_friendly, find_foodbanks, mpid_from_name, get_cred, diff_html
+from const.general import DELIVERY_HOURS_CHOICES, COUNTRIES_CHOICES, DELIVERY_PROVIDER_CHOICES, FOODBANK_NETWORK_CHOICES, PACKAGING_WEIGHT_PC, FB_GEN_MC_KEY, LOC_GEN_MC_KEY, ITEMS_GEN_MC_KEY, GEOCODE_CACHE_TTL, GEOCODE_CACHE_FAILED_TTL
+from func import parse_tesco_order_text, parse_sainsburys_order_text, clean_foodbank_need_text, admin_regions_from_postcode, constituency_from_lattlong, mp_from_parlcon, geocode, make_url_friendly, find_foodbanks, mpid_from_name, get_cred, diff_html, get_latest_needs, simplify_boundaries, get_boundary_geojson_dict, bump_generation, change_counters, counter_changes
 
 
 class Foodbank(models.Model):
@@ -61,8 +64,20 @@ class Foodbank(models.Model):
     last_social_media_check = models.DateTimeField(editable=False, null=True)
     last_need = models.DateTimeField(editable=False, null=True)
 
+    published_need_id = models.CharField(max_length=8, editable=False, null=True)
+    published_need_text = models.TextField(editable=False, null=True)
+    published_need_items = models.IntegerField(editable=False, default=0)
+    published_need_created = models.DateTimeField(editable=False, null=True)
+
     no_locations = models.IntegerField(editable=False, default=0)
 
+    # Running totals of the food bank's orders
+    order_count = models.IntegerField(editable=False, default=0)
+    order_weight = models.IntegerField(editable=False, default=0)
+    order_calories = models.IntegerField(editable=False, default=0)
+    order_cost = models.IntegerField(editable=False, default=0) #pence
+    order_items = models.IntegerField(editable=False, default=0)
+
     class Search:
          fields = [
              "name",
@@ -123,51 +138,54 @@ class Foodbank(models.Model):
         except FoodbankChange.DoesNotExist:
             return None
 
+    def published_need(self):
+        if self.published_need_id:
+            return PublishedNeed(self.published_need_id, self.published_need_text, self.published_need_created)
+        else:
+            return None
+
     def latest_need_text(self):
-        latest_need = self.latest_need()
-        if latest_need:
-            return latest_need.change_text
+        if self.published_need_id:
+            return self.published_need_text
         else:
             return "Nothing"
 
     def latest_need_id(self):
-
-        latest_need = self.latest_need()
-        if latest_need:
-            return latest_need.need_id
-        else:
-            return None
+        return self.published_need_id
 
     def latest_need_date(self):
-        latest_need = self.latest_need()
-        if latest_need:
-            return latest_need.created
+        if self.published_need_id:
+            return self.published_need_created
         else:
             return self.modified
 
     def latest_need_number(self):
-        latest_need_text = self.latest_need_text()
-        if latest_need_text == "Unknown":
-            return 0
-        if latest_need_text == "Nothing":
-            return 0
-        return latest_need_text.count('\n')+1
+        return self.published_need_items
+
+    def update_published_need(self):
+        latest_need = self.latest_need()
+        if latest_need:
+            self.published_need_id = latest_need.need_id
+            self.published_need_text = latest_need.change_text
+            self.published_need_items = latest_need.no_items()
+            self.published_need_created = latest_need.created
+        else:
+            self.published_need_id = None
+            self.published_need_text = None
+            self.published_need_items = 0
+            self.published_need_created = None
 
     def orders(self):
         return Order.objects.filter(foodbank = self).order_by("-delivery_datetime")
 
     def no_orders(self):
-        return len(self.orders())
+        return self.order_count
 
     def get_no_locations(self):
         return len(self.locations())
 
     def total_weight(self):
-        total_weight = float(0)
-        orders = self.orders()
-        for order in orders:
-            total_weight = total_weight + order.weight
-        return total_weight
+        return float(self.order_weight)
 
     def total_weight_kg(self):
         return self.total_weight() / 1000
@@ -176,18 +194,74 @@ class Foodbank(models.Model):
         return self.total_weight_kg() * PACKAGING_WEIGHT_PC
 
     def total_cost(self):
-        total_cost = float(0)
-        orders = self.orders()
-        for order in orders:
-            total_cost = total_cost + order.cost
-        return total_cost / 100
+        return float(self.order_cost) / 100
 
     def total_items(self):
-        total_items = 0
-        orders = self.orders()
-        for order in orders:
-            total_items = total_items + order.no_items
-        return total_items
+        return self.order_items
+
+    def total_calories(self):
+        return self.order_calories
+
+    def latest_order_date(self, excluding = None):
+        # The order being changed is skipped, as it may not be saved yet
+        for order in self.orders()[:2]:
+            if excluding is None or order.pk != excluding.pk:
+                return order.delivery_date
+        return None
+
+    def change_order_totals(self, changes, order_date = None, last_order = None):
+        """
+        Adds changes, a dict of the order totals to what they change by.
+        An order_date that's later than the last order becomes the last
+        order, otherwise last_order replaces it, having been looked up
+        beforehand as queries can't run in a transaction. Called in a
+        transaction this joins it, so an order and the totals it changes
+        are saved together.
+        """
+
+        with transaction.atomic(xg = True):
+            foodbank = Foodbank.objects.get(pk = self.pk)
+            for field_name, change in changes.items():
+                setattr(foodbank, field_name, getattr(foodbank, field_name) + change)
+            if order_date is None:
+                foodbank.last_order = last_order
+            elif not foodbank.last_order or order_date > foodbank.last_order:
+                foodbank.last_order = order_date
+            # Nothing else has changed, so none of our save is needed
+            super(Foodbank, foodbank).save(update_fields = list(changes) + ["last_order"])
+
+        for field_name in list(changes) + ["last_order"]:
+            setattr(self, field_name, getattr(foodbank, field_name))
+
+    def recompute_order_totals(self):
+        """
+        Corrects the order totals to what the orders add up to, by the
+        difference from the kept totals. The orders can't be counted in
+        a transaction, so if the totals change while they're counted
+        this gives up and returns False, rather than lose that change.
+        """
+
+        kept_foodbank = Foodbank.objects.get(pk = self.pk)
+        kept_totals = dict((field_name, getattr(kept_foodbank, field_name)) for field_name in Order.TOTAL_FIELDS)
+
+        totals = dict((field_name, 0) for field_name in Order.TOTAL_FIELDS)
+        for order in self.orders():
+            for field_name, total in order.order_totals().items():
+                totals[field_name] = totals[field_name] + total
+        last_order = self.latest_order_date()
+
+        with transaction.atomic():
+            foodbank = Foodbank.objects.get(pk = self.pk)
+            for field_name, total in kept_totals.items():
+                if getattr(foodbank, field_name) != total:
+                    logging.warning("Order totals for %s changed while being recounted" % (foodbank.slug))
+                    return False
+            changes = dict((field_name, total - kept_totals[field_name]) for field_name, total in totals.items() if total != kept_totals[field_name])
+            if changes:
+                logging.warning("Order totals for %s were out by %s" % (foodbank.slug, changes))
+            foodbank.change_order_totals(changes, last_order = last_order)
+
+        return True
 
     def locations(self):
         return FoodbankLocation.objects.filter(foodbank = self).order_by("name")
@@ -214,7 +288,7 @@ class Foodbank(models.Model):
 
         # Update politics
         regions = admin_regions_from_postcode(self.postcode)
-        self.parliamentary_constituency = regions.get("parliamentary_constituency", None)
+        self.parliamentary_constituency = constituency_from_lattlong(self.latt_long) or regions.get("parliamentary_constituency", None)
         self.county = regions.get("county", None)
         self.ward = regions.get("ward", None)
         self.district = regions.get("district", None)
@@ -234,10 +308,23 @@ class Foodbank(models.Model):
         except FoodbankChange.DoesNotExist:
             self.last_need = None
 
-        super(Foodbank, self).save(*args, **kwargs)
+        # Cache latest published need
+        self.update_published_need()
+
+        if not self.pk:
+            super(Foodbank, self).save(*args, **kwargs)
+            return
 
-        # Delete the now stale memcache entry
-        memcache.delete(FB_MC_KEY)
+        # Order totals are only changed by change_order_totals, so the
+        # stored ones are kept rather than what this copy has
+        with transaction.atomic():
+            try:
+                saved_foodbank = Foodbank.objects.get(pk = self.pk)
+                for field_name in Order.TOTAL_FIELDS + ("last_order",):
+                    setattr(self, field_name, getattr(saved_foodbank, field_name))
+            except Foodbank.DoesNotExist:
+                pass
+            super(Foodbank, self).save(*args, **kwargs)
 
 
 class FoodbankLocation(models.Model):
@@ -266,12 +353,27 @@ class FoodbankLocation(models.Model):
     mp_party = models.CharField(max_length=50, null=True, blank=True, verbose_name="MP's party")
     mp_parl_id = models.IntegerField(verbose_name="MP's ID")
 
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, editable=False)
+
     def __str__(self):
         return self.name
 
     def get_absolute_url(self):
         return "/admin/foodbank/%s/location/%s/edit/" % (self.foodbank.slug, self.slug)
 
+    def tombstone_key(self):
+        return "%s/%s" % (self.foodbank_slug, self.slug)
+
+    def fill_timestamps(self):
+
+        # Locations from before these were kept have neither, which
+        # leaves them out of the changes API
+        if self.created and self.modified:
+            return
+        self.created = self.created or timezone.now()
+        super(FoodbankLocation, self).save(update_fields = ["created", "modified"])
+
     def full_name(self):
         return "%s, %s" % (self.name, self.foodbank_name)
         
@@ -317,7 +419,7 @@ class FoodbankLocation(models.Model):
 
         # Update politics
         regions = admin_regions_from_postcode(self.postcode)
-        self.parliamentary_constituency = regions.get("parliamentary_constituency", None)
+        self.parliamentary_constituency = constituency_from_lattlong(self.latt_long) or regions.get("parliamentary_constituency", None)
         self.county = regions.get("county", None)
         self.ward = regions.get("ward", None)
         self.district = regions.get("district", None)
@@ -364,9 +466,28 @@ class Order(models.Model):
     class Meta:
        unique_together = ('foodbank', 'delivery_date',)
 
+    # Fields on the food bank that total up its orders
+    TOTAL_FIELDS = ("order_count", "order_weight", "order_calories", "order_cost", "order_items")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        order = super(Order, cls).from_db(db, field_names, values)
+        # Kept to tell how the food bank's totals change when it's saved
+        order.saved_totals = (order.foodbank_id, order.delivery_date, order.order_totals())
+        return order
+
     def __str__(self):
         return self.order_id
 
+    def order_totals(self):
+        return {
+            "order_count":1,
+            "order_weight":int(self.weight),
+            "order_calories":int(self.calories),
+            "order_cost":int(self.cost),
+            "order_items":int(self.no_items),
+        }
+
     def foodbank_name_slug(self):
         return slugify(self.foodbank_name)
 
@@ -385,7 +506,16 @@ class Order(models.Model):
     def delete(self, *args, **kwargs):
 
         OrderLine.objects.filter(order = self).delete()
+
+        foodbank_id, delivery_date, totals = getattr(self, "saved_totals", (self.foodbank_id, self.delivery_date, self.order_totals()))
+        foodbank = Foodbank.objects.get(pk = foodbank_id)
+        last_order = foodbank.latest_order_date(excluding = self)
+
+        # Deleting collects related objects with a query, which can't run
+        # in a transaction, so the order goes first and its totals come
+        # off after. Should that fail, /offline/order_totals/ recounts.
         super(Order, self).delete(*args, **kwargs)
+        foodbank.change_order_totals(dict((field_name, -total) for field_name, total in totals.items()), last_order = last_order)
 
     def save(self, *args, **kwargs):
         # Generate ID
@@ -400,32 +530,62 @@ class Order(models.Model):
             0,
         )
 
-        self.weight = 0
-        self.calories = 0
-        self.cost = 0
-        self.no_lines = 0
-        self.no_items = 0
-
         #denorm foodbank name & country
         self.foodbank_name = self.foodbank.name
         self.country = self.foodbank.country
 
-        super(Order, self).save(*args, **kwargs)
+        new_order_lines = self.parse_lines()
+
+        adding = self._state.adding
+
+        # Work out how the food bank's order totals and last order date
+        # change. Last orders that need looking up again are found first,
+        # as queries can't run in the transaction.
+        totals = self.order_totals()
+        saved_totals = getattr(self, "saved_totals", None)
+        if not saved_totals:
+            total_changes = [(self.foodbank, totals, {"order_date":self.delivery_date})]
+        elif saved_totals[0] != self.foodbank_id:
+            old_foodbank = Foodbank.objects.get(pk = saved_totals[0])
+            total_changes = [
+                (old_foodbank, dict((field_name, -total) for field_name, total in saved_totals[2].items()), {"last_order":old_foodbank.latest_order_date(excluding = self)}),
+                (self.foodbank, totals, {"order_date":self.delivery_date}),
+            ]
+        else:
+            changes = dict((field_name, total - saved_totals[2][field_name]) for field_name, total in totals.items())
+            if saved_totals[1] == self.delivery_date:
+                total_changes = [(self.foodbank, changes, {"order_date":self.delivery_date})]
+            else:
+                last_order = max(self.foodbank.latest_order_date(excluding = self), self.delivery_date)
+                total_changes = [(self.foodbank, changes, {"last_order":last_order})]
+
+        # The order is saved along with the totals it changes
+        with transaction.atomic(xg = True):
+            super(Order, self).save(*args, **kwargs)
+            for foodbank, changes, last_order in total_changes:
+                foodbank.change_order_totals(changes, **last_order)
+        self.saved_totals = (self.foodbank_id, self.delivery_date, totals)
 
-        # Delete all the existing orderlines
-        OrderLine.objects.filter(order = self).delete()
+        self.save_lines(new_order_lines, adding)
+
+    def parse_lines(self):
+        """
+        The order's lines, parsed from its items text, which are totalled
+        up onto the order.
+        """
 
         if self.delivery_provider == "Tesco" or self.delivery_provider == "Costco" or self.delivery_provider == "Pedal Me":
             order_lines = parse_tesco_order_text(self.items_text)
         elif self.delivery_provider == "Sainsbury's":
             order_lines = parse_sainsburys_order_text(self.items_text)
 
-
         order_weight = 0
         order_calories = 0
         order_cost = 0
         order_items = 0
 
+        new_order_lines = []
+
         for order_line in order_lines:
 
             line_calories = 0
@@ -448,17 +608,16 @@ class Order(models.Model):
 
             order_items = order_items + order_line.get("quantity")
 
-            new_order_line = OrderLine(
+            new_order_lines.append(OrderLine(
                 foodbank = self.foodbank,
-                order = self,
                 name = order_line.get("name"),
                 quantity = order_line.get("quantity"),
                 item_cost = order_line.get("item_cost"),
                 line_cost = line_cost,
-                weight = line_weight,
-                calories = order_line.get("calories"),
-            )
-            new_order_line.save()
+                # As they'll be stored, so they compare with saved lines
+                weight = int(line_weight),
+                calories = int(line_calories),
+            ))
 
         self.weight = order_weight
         self.calories = order_calories
@@ -466,11 +625,34 @@ class Order(models.Model):
         self.no_lines = len(order_lines)
         self.no_items = order_items
 
-        super(Order, self).save(*args, **kwargs)
+        return new_order_lines
 
-        # Update last order date on foodbank
-        self.foodbank.last_order = self.delivery_datetime
-        self.foodbank.save()
+    def save_lines(self, new_order_lines, adding):
+        """
+        Saves the order's lines, only writing those that have changed.
+        """
+
+        if adding:
+            existing_order_lines = []
+        else:
+            existing_order_lines = list(OrderLine.objects.filter(order = self))
+        unchanged_order_lines = {}
+        for existing_order_line in existing_order_lines:
+            unchanged_order_lines.setdefault(existing_order_line.diff_key(), []).append(existing_order_line)
+
+        to_create = []
+        for new_order_line in new_order_lines:
+            new_order_line.order = self
+            if unchanged_order_lines.get(new_order_line.diff_key()):
+                unchanged_order_lines[new_order_line.diff_key()].pop()
+            else:
+                to_create.append(new_order_line)
+
+        to_delete = [order_line.pk for order_lines in unchanged_order_lines.values() for order_line in order_lines]
+        if to_delete:
+            OrderLine.objects.filter(pk__in = to_delete).delete()
+        if to_create:
+            OrderLine.objects.bulk_create(to_create)
 
     def lines(self):
         return OrderLine.objects.filter(order = self).order_by("-weight")
@@ -492,6 +674,10 @@ class OrderLine(models.Model):
     def weight_kg(self):
         return self.weight/1000
 
+    def diff_key(self):
+        # Lines with the same key are the same line
+        return (self.foodbank_id, self.name, self.quantity, self.item_cost, self.line_cost, self.weight, self.calories)
+
 
 class OrderItem(models.Model):
 
@@ -554,6 +740,16 @@ class FoodbankChange(models.Model):
              "change_text",
          ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        need = super(FoodbankChange, cls).from_db(db, field_names, values)
+        # Kept to tell when a published need is unpublished, and how the
+        # need counters change
+        need.was_published = need.published
+        need.saved_items = need.no_items()
+        need.saved_foodbank_id = need.foodbank_id
+        return need
+
     def clean(self):
         if self.foodbank == None and self.published == True:
             raise ValidationError('Need to set a food bank to publish need')
@@ -628,10 +824,64 @@ class FoodbankChange(models.Model):
 
         super(FoodbankChange, self).save(*args, **kwargs)
 
+        # Unpublishing takes the need out of the API, as deleting does
+        if getattr(self, "was_published", False) and not self.published:
+            Tombstone(kind = "need", key = self.need_id).save()
+        self.was_published = self.published
+
+        # Needs are counted for the country of their food bank too
+        country = self.foodbank and self.foodbank.country
+        counts = {"needs":1, "need_items":self.no_items()}
+        if not hasattr(self, "saved_items"):
+            change_counters(counter_changes(counts, country))
+        else:
+            if self.saved_foodbank_id == self.foodbank_id:
+                saved_country = country
+            else:
+                saved_country = foodbank_country(self.saved_foodbank_id)
+            change_counters(counter_changes(counts, country), counter_changes({"needs":1, "need_items":self.saved_items}, saved_country, -1))
+        self.saved_items = self.no_items()
+        self.saved_foodbank_id = self.foodbank_id
+
+        if self.foodbank:
+            deferred.defer(self.foodbank.save)
+
+    def delete(self, *args, **kwargs):
+
+        super(FoodbankChange, self).delete(*args, **kwargs)
+
+        # Resave the food bank, to update its latest published need
         if self.foodbank:
             deferred.defer(self.foodbank.save)
 
 
+class PublishedNeed(object):
+    """
+    A food bank's latest published need, from the copy kept on the food
+    bank. Has the parts of FoodbankChange that pages and the API use.
+    """
+
+    def __init__(self, need_id, change_text, created):
+        self.need_id = need_id
+        self.change_text = change_text
+        self.created = created
+
+    def no_items(self):
+        if self.change_text == "Unknown" or self.change_text == "Nothing":
+            return 0
+        else:
+            return len(self.change_text.split('\n'))
+
+    def change_list(self):
+        return self.change_text.split("\n")
+
+    def clean_change_text(self):
+        if self.change_text:
+            return unicodedata.normalize('NFKD', self.change_text).encode('ascii', 'ignore')
+        else:
+            return None
+
+
 class ApiFoodbankSearch(models.Model):
 
     created = models.DateTimeField(auto_now_add=True, editable=False)
@@ -678,6 +928,43 @@ class ApiFoodbankSearch(models.Model):
         super(ApiFoodbankSearch, self).save(*args, **kwargs)
 
 
+class Tombstone(models.Model):
+    """
+    Marks a food bank, location or published need as gone from the API,
+    so the changes API can tell mirrors to delete it.
+    """
+
+    TOMBSTONE_KINDS = (
+        ("foodbank", "Food bank"),
+        ("location", "Location"),
+        ("need", "Need"),
+    )
+
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    kind = models.CharField(max_length=10, choices=TOMBSTONE_KINDS)
+    key = models.CharField(max_length=101)
+
+    def __str__(self):
+        return "%s %s" % (self.kind, self.key)
+
+
+class GeocodeResult(models.Model):
+
+    # Geocoded addresses, keyed on the normalised address
+
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, editable=False)
+    address = models.CharField(max_length=255, unique=True)
+    latt_long = models.CharField(max_length=50, verbose_name="Latt,Long")
+
+    def expires(self):
+        if self.latt_long == "0,0":
+            ttl = GEOCODE_CACHE_FAILED_TTL
+        else:
+            ttl = GEOCODE_CACHE_TTL
+        return calendar.timegm(self.modified.utctimetuple()) + ttl
+
+
 class ParliamentaryConstituency(models.Model):
 
     name = models.CharField(max_length=50, null=True, blank=True)
@@ -690,28 +977,34 @@ class ParliamentaryConstituency(models.Model):
 
     electorate = models.IntegerField(null=True, blank=True)
     boundary_geojson = models.TextField(null=True, blank=True)
+    boundary_geojson_simplified = models.TextField(null=True, blank=True, editable=False)
     
-    def boundary_geojson_dict(self):
-        boundary_geojson = self.boundary_geojson.strip()
-        # remove last char if a comma
-        if boundary_geojson[-1:] == ",":
-            boundary_geojson = boundary_geojson[:-1]
-        else:
-            boundary_geojson = boundary_geojson
-        return json.loads(boundary_geojson)
+    def boundary_geojson_dict(self, simplify=None, precision=None):
+
+        # Constituencies saved before boundaries were simplified on save
+        # get theirs the first time they're asked for
+        if simplify and self.boundary_geojson and not self.boundary_geojson_simplified:
+            self.boundary_geojson_simplified = simplify_boundaries(self.boundary_geojson)
+            super(ParliamentaryConstituency, self).save(update_fields = ["boundary_geojson_simplified"])
+
+        return get_boundary_geojson_dict(self.boundary_geojson, self.boundary_geojson_simplified, simplify, precision)
 
     def foodbanks(self):
 
         foodbanks = Foodbank.objects.filter(parliamentary_constituency_slug = self.slug)
         locations = FoodbankLocation.objects.filter(parliamentary_constituency_slug = self.slug)
 
+        latest_needs = get_latest_needs(
+            [foodbank.name for foodbank in foodbanks] + [location.foodbank_name for location in locations]
+        )
+
         constituency_foodbanks = []
         for foodbank in foodbanks:
             constituency_foodbanks.append({
                 "name":foodbank.name,
                 "slug":foodbank.slug,
                 "lat_lng":foodbank.latt_long,
-                "needs":foodbank.latest_need()
+                "needs":latest_needs.get(foodbank.name)
             })
 
         for location in locations:
@@ -719,7 +1012,7 @@ class ParliamentaryConstituency(models.Model):
                 "name":location.foodbank_name,
                 "slug":location.foodbank_slug,
                 "lat_lng":location.latt_long,
-                "needs":location.latest_need()
+                "needs":latest_needs.get(location.foodbank_name)
             })
         
         constituency_foodbanks = {v['name']:v for v in constituency_foodbanks}.values()
@@ -733,6 +1026,13 @@ class ParliamentaryConstituency(models.Model):
     def save(self, *args, **kwargs):
 
         self.slug = slugify(self.name)
+
+        # Precompute the simplified boundaries
+        if self.boundary_geojson:
+            self.boundary_geojson_simplified = simplify_boundaries(self.boundary_geojson)
+        else:
+            self.boundary_geojson_simplified = None
+
         super(ParliamentaryConstituency, self).save(*args, **kwargs)
 
 
@@ -758,6 +1058,14 @@ class FoodbankSubscriber(models.Model):
     class Meta:
        unique_together = ('email', 'foodbank',)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        subscriber = super(FoodbankSubscriber, cls).from_db(db, field_names, values)
+        # Kept to tell how the subscriptions counter changes
+        subscriber.was_confirmed = subscriber.confirmed
+        subscriber.saved_foodbank_id = subscriber.foodbank_id
+        return subscriber
+
     def save(self, *args, **kwargs):
 
         if not self.sub_key:
@@ -766,4 +1074,84 @@ class FoodbankSubscriber(models.Model):
             self.unsub_key = hashlib.sha256("unsub-%s-%s" % (datetime.now(), salt)).hexdigest()[:16]
 
         self.foodbank_name = self.foodbank.name
-        super(FoodbankSubscriber, self).save(*args, **kwargs)
\ No newline at end of file
+        super(FoodbankSubscriber, self).save(*args, **kwargs)
+
+        # Subscriptions are counted for the country of their food bank too
+        saved_foodbank_id = getattr(self, "saved_foodbank_id", self.foodbank_id)
+        if saved_foodbank_id == self.foodbank_id:
+            saved_country = self.foodbank.country
+        else:
+            saved_country = foodbank_country(saved_foodbank_id)
+        change_counters(counter_changes({"subscriptions":int(self.confirmed)}, self.foodbank.country), counter_changes({"subscriptions":int(getattr(self, "was_confirmed", False))}, saved_country, -1))
+        self.was_confirmed = self.confirmed
+        self.saved_foodbank_id = self.foodbank_id
+
+
+class CounterShard(models.Model):
+    """
+    A part of one of the counters kept by change_counters.
+    """
+
+    shard_id = models.CharField(max_length=50, primary_key=True)
+    name = models.CharField(max_length=50)
+    count = models.IntegerField(default=0)
+
+
+def foodbank_country(foodbank_id):
+    # The country of a food bank that may since have been deleted
+    if foodbank_id is None:
+        return None
+    try:
+        return Foodbank.objects.get(pk = foodbank_id).country
+    except Foodbank.DoesNotExist:
+        return None
+
+
+# Anything cached from these kinds is keyed on their generation, so
+# bumping it is all that's needed when one changes
+
+@receiver([post_save, post_delete], sender=Foodbank)
+def foodbank_changed(sender, **kwargs):
+    bump_generation(FB_GEN_MC_KEY)
+
+
+@receiver([post_save, post_delete], sender=FoodbankLocation)
+def location_changed(sender, **kwargs):
+    bump_generation(LOC_GEN_MC_KEY)
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def item_changed(sender, **kwargs):
+    bump_generation(ITEMS_GEN_MC_KEY)
+
+
+# Deletions leave a tombstone for the changes API
+
+@receiver(post_delete, sender=Foodbank)
+def foodbank_deleted(sender, instance, **kwargs):
+    Tombstone(kind = "foodbank", key = instance.slug).save()
+
+
+@receiver(post_delete, sender=FoodbankLocation)
+def location_deleted(sender, instance, **kwargs):
+    Tombstone(kind = "location", key = instance.tombstone_key()).save()
+
+
+@receiver(post_delete, sender=FoodbankChange)
+def need_deleted(sender, instance, **kwargs):
+    if instance.published:
+        Tombstone(kind = "need", key = instance.need_id).save()
+
+
+# Deletions come off the counters kept by change_counters
+
+@receiver(post_delete, sender=FoodbankChange)
+def need_counted_out(sender, instance, **kwargs):
+    counts = {"needs":1, "need_items":getattr(instance, "saved_items", instance.no_items())}
+    change_counters(counter_changes(counts, foodbank_country(getattr(instance, "saved_foodbank_id", instance.foodbank_id)), -1))
+
+
+@receiver(post_delete, sender=FoodbankSubscriber)
+def subscriber_counted_out(sender, instance, **kwargs):
+    if getattr(instance, "was_confirmed", instance.confirmed):
+        change_counters(counter_changes({"subscriptions":1}, foodbank_country(getattr(instance, "saved_foodbank_id", instance.foodbank_id)), -1))
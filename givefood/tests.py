@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import random
+import operator
+import threading
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.test import SimpleTestCase
+
+import givefood.func
+from givefood.func import SpatialIndex, DistanceEngine, distance_meters, find_foodbanks, PostcodeIndex, get_weight, parse_weight
+from givefood.models import Foodbank, Order, OrderLine
+
+
+def random_lat_lngs(count, seed):
+
+    rand = random.Random(seed)
+    lat_lngs = [(rand.uniform(49.9, 58.7), rand.uniform(-8.0, 1.8)) for i in range(count)]
+    # Some places in the same spot, so there are ties to settle
+    return lat_lngs + lat_lngs[:count // 20]
+
+
+def brute_force_nearest(lat_lngs, latt, long, quantity, skip_first = False):
+    """
+    The nearest places the way find_foodbanks used to find them, by
+    measuring them all and sorting the lot.
+    """
+
+    places = [(distance_meters(place_latt, place_long, latt, long), index) for index, (place_latt, place_long) in enumerate(lat_lngs)]
+    places = sorted(places, key=operator.itemgetter(0))
+
+    if skip_first:
+        return places[1:quantity + 1]
+    return places[:quantity]
+
+
+class SpatialIndexTest(SimpleTestCase):
+
+    def setUp(self):
+
+        self.lat_lngs = random_lat_lngs(2000, 1)
+        self.rand = random.Random(2)
+
+    def queries(self, count):
+
+        for i in range(count):
+            if self.rand.random() < 0.2:
+                latt, long = self.rand.choice(self.lat_lngs)
+            else:
+                latt, long = self.rand.uniform(49.0, 59.0), self.rand.uniform(-9.0, 2.0)
+            yield latt, long, self.rand.choice([1, 3, 10, 50]), self.rand.random() < 0.5
+
+    def assertSameNearest(self, found, expected):
+
+        self.assertEqual([index for distance, index in found], [index for distance, index in expected])
+        for (found_distance, found_index), (expected_distance, expected_index) in zip(found, expected):
+            self.assertAlmostEqual(found_distance, expected_distance, places = 3)
+
+    def test_matches_brute_force(self):
+
+        spatial_index = SpatialIndex(range(len(self.lat_lngs)), self.lat_lngs)
+        for latt, long, quantity, skip_first in self.queries(200):
+            self.assertSameNearest(
+                spatial_index.nearest(latt, long, quantity, skip_first),
+                brute_force_nearest(self.lat_lngs, latt, long, quantity, skip_first),
+            )
+
+    def test_small_index(self):
+
+        lat_lngs = self.lat_lngs[:3]
+        spatial_index = SpatialIndex(range(3), lat_lngs)
+        self.assertSameNearest(spatial_index.nearest(52.0, -1.0, 10), brute_force_nearest(lat_lngs, 52.0, -1.0, 10))
+        self.assertEqual(SpatialIndex([], []).nearest(52.0, -1.0, 10), [])
+
+    def test_engine_distances_are_exact(self):
+
+        engine = DistanceEngine(self.lat_lngs)
+        query = engine.query(51.5, -0.12)
+        distances = engine.distances(query, range(len(self.lat_lngs)))
+        for (latt, long), distance in zip(self.lat_lngs, distances):
+            self.assertEqual(distance, distance_meters(latt, long, 51.5, -0.12))
+
+
+class FakeFoodbank(object):
+
+    def __init__(self, name, latt, long):
+        self.name = name
+        self._latt = latt
+        self._long = long
+
+    def latt(self):
+        return self._latt
+
+    def long(self):
+        return self._long
+
+
+class ConcurrentSearchTest(SimpleTestCase):
+
+    THREADS = 8
+    SEARCHES = 100
+
+    def setUp(self):
+
+        self.lat_lngs = random_lat_lngs(1000, 3)
+        self.foodbanks = [FakeFoodbank("Food bank %s" % (index), latt, long) for index, (latt, long) in enumerate(self.lat_lngs)]
+        search_index = SpatialIndex(self.foodbanks, self.lat_lngs)
+
+        self.get_search_index = givefood.func.get_search_index
+        givefood.func.get_search_index = lambda index_name: search_index
+
+    def tearDown(self):
+
+        givefood.func.get_search_index = self.get_search_index
+
+    def test_parallel_searches(self):
+
+        rand = random.Random(4)
+        searches = []
+        for i in range(self.THREADS * self.SEARCHES):
+            latt, long = rand.uniform(49.0, 59.0), rand.uniform(-9.0, 2.0)
+            expected = [(self.foodbanks[index].name, distance) for distance, index in brute_force_nearest(self.lat_lngs, latt, long, 10)]
+            searches.append(("%s,%s" % (latt, long), expected))
+
+        failures = []
+        start = threading.Event()
+
+        def search(thread_searches):
+            start.wait()
+            for lattlong, expected in thread_searches:
+                results = find_foodbanks(lattlong, 10)
+                found = [(result.name, result.distance_m) for result in results]
+                if [name for name, distance in found] != [name for name, distance in expected]:
+                    failures.append(lattlong)
+                elif any(abs(found_distance - expected_distance) > 0.001 for (found_name, found_distance), (expected_name, expected_distance) in zip(found, expected)):
+                    failures.append(lattlong)
+                elif any(abs(result.distance_mi - result.distance_m * 0.000621371192) > 0.000001 for result in results):
+                    failures.append(lattlong)
+
+        threads = [threading.Thread(target = search, args = (searches[i::self.THREADS],)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(failures, [])
+        # The shared food banks are never written to
+        for foodbank in self.foodbanks:
+            self.assertFalse(hasattr(foodbank, "distance_m"))
+            self.assertFalse(hasattr(foodbank, "distance_mi"))
+
+
+class PostcodeIndexTest(SimpleTestCase):
+
+    CSV = "\n".join([
+        "pcds,doterm,lat,long",
+        "SW1A 1AA,,51.501009,-0.141588",
+        "SW1A 2AA,,51.503540,-0.127695",
+        "EH1 1BB,,55.952271,-3.188840",
+        "EH1 1YZ,201901,55.953000,-3.189000",
+        "ZZ99 9ZZ,,99.999999,0.000000",
+    ])
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        PostcodeIndex.from_csv(StringIO(self.CSV)).save(self.directory)
+        self.postcode_index = PostcodeIndex.load(self.directory)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def assertNear(self, lat_lng, expected):
+
+        # Coordinates are stored as 32 bit floats, good to about a metre
+        self.assertNotEqual(lat_lng, None)
+        self.assertAlmostEqual(lat_lng[0], expected[0], places = 4)
+        self.assertAlmostEqual(lat_lng[1], expected[1], places = 4)
+
+    def test_postcodes(self):
+
+        self.assertEqual(len(self.postcode_index), 3)
+        self.assertNear(self.postcode_index.lat_lng("SW1A1AA"), (51.501009, -0.141588))
+        self.assertNear(self.postcode_index.lat_lng("EH11BB"), (55.952271, -3.18884))
+        self.assertEqual(self.postcode_index.lat_lng("ZZ999ZZ"), None)
+
+    def test_outcodes(self):
+
+        self.assertNear(self.postcode_index.lat_lng("SW1A"), (51.502274, -0.134642))
+        # Terminated postcodes aren't counted, and unknown postcodes fall
+        # back to their outcode
+        self.assertNear(self.postcode_index.lat_lng("EH1"), (55.952271, -3.18884))
+        self.assertNear(self.postcode_index.lat_lng("EH11YZ"), (55.952271, -3.18884))
+
+    def test_missing_data(self):
+
+        postcode_index = PostcodeIndex.load(os.path.join(self.directory, "missing"))
+        self.assertEqual(len(postcode_index), 0)
+        self.assertEqual(postcode_index.lat_lng("SW1A1AA"), None)
+
+
+class WeightTest(SimpleTestCase):
+
+    CORPUS_FILE = os.path.join(os.path.dirname(__file__), "data", "eg_item_weights.tsv")
+
+    def corpus(self):
+
+        with io.open(self.CORPUS_FILE, encoding = "utf-8") as corpus_file:
+            for line in corpus_file:
+                if line.startswith(u"#") or not line.strip():
+                    continue
+                columns = line.rstrip(u"\n").split(u"\t")
+                yield columns[0], float(columns[1])
+
+    def test_corpus(self):
+
+        # Every item we've had, and the old suffix table's cases
+        for name, weight in self.corpus():
+            self.assertEqual(parse_weight(name), weight, name)
+            self.assertEqual(get_weight(name), weight, name)
+            # A second time from the memo
+            self.assertEqual(get_weight(name), weight, name)
+
+    def test_sizes(self):
+
+        self.assertEqual(parse_weight(u"Tesco Baked Beans 4 X 420G"), 1680)
+        self.assertEqual(parse_weight(u"Tesco Pasta 1.5Kg"), 1500)
+        self.assertEqual(parse_weight(u"Tesco Orange Juice 1 Litre"), 1000)
+        self.assertEqual(parse_weight(u"Tesco Chickpeas 400G (240G*)"), 400)
+        self.assertEqual(parse_weight(u"Tesco Mince Pies 6 Pack"), parse_weight(u"Tesco Lattice Mince Pies 6 Pack"))
+        self.assertEqual(parse_weight(u"Tesco Bananas Loose"), 0)
+
+
+class FakeItemCatalogue(object):
+
+    CALORIES = {
+        u"Tesco Baked Beans 415G":73,
+        u"Tesco Sparkling Water 330ml":70,
+    }
+
+    def calories(self, name):
+        return self.CALORIES[name]
+
+
+class FakeOrderLines(object):
+    """
+    Stands in for OrderLine.objects, keeping what's deleted and created.
+    """
+
+    def __init__(self, saved_order_lines):
+        self.saved_order_lines = saved_order_lines
+        self.deleted = []
+        self.created = []
+
+    def filter(self, **kwargs):
+        if "pk__in" in kwargs:
+            return FakeDeletion(self, kwargs["pk__in"])
+        return list(self.saved_order_lines)
+
+    def bulk_create(self, order_lines):
+        self.created.extend(order_lines)
+
+
+class FakeDeletion(object):
+
+    def __init__(self, order_lines, pks):
+        self.order_lines = order_lines
+        self.pks = pks
+
+    def delete(self):
+        self.order_lines.deleted.extend(self.pks)
+
+
+class OrderLinesTest(SimpleTestCase):
+
+    # Fractional calories, and calories with float error, as the
+    # datastore would truncate them
+    ORDER_TEXT = u"1\tTesco Baked Beans 415G\t\xa30.32\t\xa30.32\n1\tTesco Sparkling Water 330ml\t\xa30.20\t\xa30.20"
+
+    def setUp(self):
+
+        self.get_item_catalogue = givefood.func.get_item_catalogue
+        givefood.func.get_item_catalogue = lambda: FakeItemCatalogue()
+        self.objects = OrderLine.objects
+
+        foodbank = Foodbank(pk = 1, name = "Test", slug = "test")
+        self.order = Order(pk = 1, foodbank = foodbank, delivery_provider = "Tesco", items_text = self.ORDER_TEXT)
+
+    def tearDown(self):
+
+        givefood.func.get_item_catalogue = self.get_item_catalogue
+        OrderLine.objects = self.objects
+
+    def saved(self, order_lines):
+        """
+        The lines as they come back from the datastore.
+        """
+
+        saved_order_lines = []
+        for pk, order_line in enumerate(order_lines):
+            saved_order_line = OrderLine(pk = pk + 1, foodbank_id = order_line.foodbank_id)
+            for field_name in ("name", "quantity", "item_cost", "line_cost", "weight", "calories"):
+                field = OrderLine._meta.get_field(field_name)
+                setattr(saved_order_line, field_name, field.to_python(field.get_prep_value(getattr(order_line, field_name))))
+            saved_order_lines.append(saved_order_line)
+        return saved_order_lines
+
+    def test_unchanged_order(self):
+
+        order_lines = FakeOrderLines(self.saved(self.order.parse_lines()))
+        OrderLine.objects = order_lines
+
+        self.order.save_lines(self.order.parse_lines(), False)
+        self.assertEqual(order_lines.deleted, [])
+        self.assertEqual(order_lines.created, [])
+
+    def test_changed_line(self):
+
+        order_lines = FakeOrderLines(self.saved(self.order.parse_lines()))
+        OrderLine.objects = order_lines
+
+        self.order.items_text = self.ORDER_TEXT.replace(u"1\tTesco Baked Beans", u"2\tTesco Baked Beans")
+        self.order.save_lines(self.order.parse_lines(), False)
+        self.assertEqual(order_lines.deleted, [1])
+        self.assertEqual(len(order_lines.created), 1)
+        self.assertEqual(order_lines.created[0].quantity, 2)
@@ -14,6 +14,7 @@ from django.contrib import admin
 admin.autodiscover()
 
 urlpatterns = (
+    url(r'^_ah/warmup/?$', givefood.views.warmup, name="warmup"),
     url(r'^_ah/', include('djangae.urls')),
 
     # PUBLIC
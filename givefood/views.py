@@ -16,10 +16,11 @@ from django.template.loader import render_to_string
 from django.http import HttpResponse, Http404, HttpResponseRedirect, HttpResponseForbidden
 from django.template.defaultfilters import slugify
 from session_csrf import anonymous_csrf
+from djangae.views import warmup as djangae_warmup
 
 from givefood.models import Foodbank, Order, FoodbankChange, FoodbankLocation, ParliamentaryConstituency
 from givefood.forms import FoodbankRegistrationForm
-from givefood.func import get_image, item_class_count, clean_foodbank_need_text, get_all_foodbanks, get_all_locations, get_all_constituencies, admin_regions_from_postcode, find_foodbanks, find_locations, geocode, find_locations, get_cred
+from givefood.func import get_image, item_class_count, clean_foodbank_need_text, get_all_foodbanks, get_all_locations, get_all_constituencies, admin_regions_from_postcode, find_foodbanks, find_locations, geocode, find_locations, get_cred, get_order_totals, get_postcode_index
 from givefood.func import send_email
 from givefood.const.general import PACKAGING_WEIGHT_PC, CHECK_COUNT_PER_DAY, PAGE_SIZE_PER_COUNT
 from givefood.const.item_classes import TOMATOES, RICE, PUDDINGS, SOUP, FRUIT, MILK, MINCE_PIES
@@ -28,28 +29,18 @@ from givefood.const.item_classes import TOMATOES, RICE, PUDDINGS, SOUP, FRUIT, M
 @cache_page(60*20)
 def public_index(request):
 
-    total_weight = 0
-    total_calories = 0
-    total_items = 0
-
-    orders = Order.objects.all()
-    active_foodbanks = set()
+    order_totals = get_order_totals()["total"]
     foodbanks = get_all_foodbanks()
     locations = get_all_locations()
 
     TOTAL_PPE_WEIGHT = 2.715
 
-    for order in orders:
-        total_weight = total_weight + order.weight
-        total_calories = total_calories + order.calories
-        total_items = total_items + order.no_items
-        active_foodbanks.add(order.foodbank_name)
-
-    total_weight = float(total_weight) / 1000000
+    total_weight = float(order_totals["weight"]) / 1000000
     total_weight = (total_weight * PACKAGING_WEIGHT_PC) + TOTAL_PPE_WEIGHT
-    total_calories = float(total_calories) / 1000000
+    total_calories = float(order_totals["calories"]) / 1000000
+    total_items = order_totals["items"]
 
-    no_active_foodbanks = len(active_foodbanks)
+    no_active_foodbanks = order_totals["active_foodbanks"]
     total_locations = len(locations) + len(foodbanks)
     for foodbank in foodbanks:
         if foodbank.delivery_address:
@@ -265,4 +256,11 @@ def proxy(request, item):
             content = json.loads(content)
             content = json.dumps(content, indent=4)
 
-        return HttpResponse(content)
\ No newline at end of file
+        return HttpResponse(content)
+
+
+def warmup(request):
+
+    # Load the postcode data before the instance takes requests
+    get_postcode_index()
+    return djangae_warmup(request)